@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+# -*- mode: python -*-
+
+"""
+End-to-end benchmark of sabo.
+
+Starts two fake IRC networks and the webhook stand-ins in process,
+generates an etc/default.yaml style configuration pointing at them, runs
+sabo.setup() on the same reactor and replays synthetic traffic:
+
+  join     time until all channels, --channels of them extra, are joined
+  latency  `!time <id>' commands, privmsg -> reply latency percentiles
+  fanout   relay traffic from bench-a/#relay to bench-b/#relay
+  stream   `!tail' replies of a slow webhook, streamed and whole,
+           time to the first and the last line
+  ingest   newline-delimited JSON batches posted to /message
+
+The report is printed as JSON (or written to --output) so that runs of
+different commits can be compared. With --profile the reactor thread is
+profiled through /profile during latency and fanout, the summary goes
+into the report and the stats dump into the given file. CPU and memory
+include the in-process stand-ins.
+
+usage: bench/bench.py [--lines N] [--rate N] [--channels N] [--tail N]
+                      [--batches N] [--batch N] [--journal DIR] [--python]
+                      [--profile FILE] [--output FILE]
+
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import tempfile
+import resource
+import subprocess
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from twisted.internet import reactor, defer, task
+from twisted.web import server
+from twisted.web.client import Agent, FileBodyProducer, readBody
+from twisted.web.http_headers import Headers
+from twisted.python import log
+from cStringIO import StringIO
+from yaml import safe_dump
+
+from fakeirc import FakeIRCFactory, webhooks
+
+NICK = "sabo-bench"
+MEMBERS = ["user%03d" % i for i in range(200)]
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def usage():
+    r = resource.getrusage(resource.RUSAGE_SELF)
+    return (r.ru_utime + r.ru_stime, r.ru_maxrss / 1024.0)
+
+
+def commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except Exception:
+        return None
+
+
+def make_config(ports, controller, webhook, journal=None, python=False,
+                extra=0):
+    base = "http://127.0.0.1:%d" % webhook
+    servers = [dict(name=name, nick=NICK, host="127.0.0.1", port=port,
+                    encoding="utf-8", schedule_interval=0.05,
+                    max_queue=100000, max_queue_bytes=1 << 26)
+               for name, port in sorted(ports.items())]
+    channels = [dict(server="bench-a", name="#bench", encoding="utf-8"),
+                dict(server="bench-a", name="#relay", encoding="utf-8"),
+                dict(server="bench-b", name="#relay", encoding="utf-8"),
+                dict(server="bench-b", name="#ingest", encoding="utf-8")]
+    # every tenth extra channel has a key
+    channels.extend(dict(server="bench-b", name="#extra%04d" % i,
+                         **(dict(password="key%d" % i) if i % 10 == 0
+                            else dict()))
+                    for i in range(extra))
+    handlers = [
+        dict(match_text="^!more$", type="privmsg", builtin="more"),
+        dict(match_text="^!time", type="privmsg", context=[],
+             **(dict(python="fakeirc:time_plugin") if python else
+                dict(http=base + "/time.rpy"))),
+        dict(match_text="^!tail", type="privmsg", context=[],
+             http=base + "/tail.rpy"),
+        dict(match_server="^bench-a$", match_channel="^#relay$",
+             match_text=".(?<!!).*", type="privmsg",
+             prefix="<%{user}> ", redirect=["bench-b/#relay"],
+             rewrites=[dict(match_text="https?://[a-zA-Z0-9.@&=%+/:?-]+",
+                            http=base + "/tinyurl.rpy")]),
+    ]
+    config = dict(profile=dict(name="bench"),
+                  controller=dict(host="127.0.0.1", port=controller),
+                  connect_interval=0.2,
+                  servers=servers, channels=channels, handlers=handlers)
+    if journal:
+        config["journal"] = dict(path=journal)
+    return config
+
+
+class Bench(object):
+
+    def __init__(self, options):
+        self.options = options
+        self.networks = dict()
+        self.sent = dict()
+        self.latencies = list()
+        self.fanout = list()
+        self.tail = list()
+        self.results = dict()
+        for name in ("bench-a", "bench-b"):
+            f = FakeIRCFactory(name, MEMBERS)
+            f.listeners.append(self.received)
+            self.networks[name] = f
+
+    def received(self, network, target, text, when):
+        if network == "bench-a" and target == "#bench":
+            for reply in text.split(" | "):
+                token = reply.rsplit("!time ", 1)[-1].strip()
+                if token in self.sent:
+                    self.latencies.append(when - self.sent.pop(token))
+            self.tail.extend([when] * text.count("tail "))
+        elif network == "bench-b" and target == "#relay":
+            # relayed lines may be packed into one PRIVMSG
+            self.fanout.extend([when] * text.count("relay "))
+
+    def listen(self):
+        ports = dict()
+        for name, f in self.networks.items():
+            ports[name] = reactor.listenTCP(0, f, interface="127.0.0.1") \
+                .getHost().port
+        webhook = reactor.listenTCP(0, server.Site(webhooks()),
+                                    interface="127.0.0.1").getHost().port
+        # find a free port for the controller
+        probe = socket.socket()
+        probe.bind(("127.0.0.1", 0))
+        self.controller = probe.getsockname()[1]
+        probe.close()
+        return make_config(ports, self.controller, webhook,
+                           self.options.journal, self.options.python,
+                           self.options.channels)
+
+    @defer.inlineCallbacks
+    def wait_joined(self):
+        b = self.networks["bench-b"]
+        channels = ["#relay", "#ingest"] + \
+            ["#extra%04d" % i for i in range(self.options.channels)]
+        while not (self.networks["bench-a"].joined("#relay") and
+                   all(b.joined(x) for x in channels)):
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        self.results["join"] = dict(
+            channels=len(channels) + 2,
+            join_lines=sum(x.join_lines for x in self.networks.values()),
+            seconds=time.time() - self.started)
+
+    @defer.inlineCallbacks
+    def replay(self, network, channel, lines, rate, stamp=None):
+        interval = 1.0 / rate
+        start = time.time()
+        for i, text in enumerate(lines):
+            if stamp is not None:
+                stamp(i)
+            self.networks[network].inject(MEMBERS[i % len(MEMBERS)],
+                                          channel, text)
+            delay = start + (i + 1) * interval - time.time()
+            if delay > 0:
+                yield task.deferLater(reactor, delay, lambda: None)
+
+    @defer.inlineCallbacks
+    def settle(self, done, timeout=30):
+        deadline = time.time() + timeout
+        while not done() and time.time() < deadline:
+            yield task.deferLater(reactor, 0.05, lambda: None)
+
+    def _phase(self, name, started, lines, extra):
+        cpu, rss = usage()
+        duration = time.time() - started[0]
+        rate = lines / duration if duration > 0 else 0
+        report = dict(duration=duration,
+                      lines_per_sec=rate,
+                      cpu_seconds=cpu - started[1],
+                      max_rss_mb=rss)
+        if rate > 0:
+            report["cpu_per_1k_lines_sec"] = \
+                (cpu - started[1]) / duration / (rate / 1000.0)
+            report["rss_mb_per_1k_lines_sec"] = rss / (rate / 1000.0)
+        report.update(extra)
+        self.results[name] = report
+
+    @defer.inlineCallbacks
+    def latency(self):
+        n, rate = self.options.lines, self.options.rate
+        started = (time.time(), usage()[0])
+        lines = ["!time %d" % i for i in range(n)]
+
+        def __stamp(i):
+            self.sent[str(i)] = time.time()
+
+        yield self.replay("bench-a", "#bench", lines, rate, __stamp)
+        yield self.settle(lambda: not self.sent)
+        ms = [x * 1000 for x in self.latencies]
+        self._phase("latency", started, 2 * len(ms), dict(
+            sent=n, replies=len(ms),
+            p50_ms=percentile(ms, 50), p90_ms=percentile(ms, 90),
+            p99_ms=percentile(ms, 99), max_ms=max(ms) if ms else None))
+
+    @defer.inlineCallbacks
+    def fanout_phase(self):
+        n, rate = self.options.lines, self.options.rate * 2
+        started = (time.time(), usage()[0])
+        lines = ["relay %d http://example.com/%d" % (i, i % 50)
+                 for i in range(n)]
+        yield self.replay("bench-a", "#relay", lines, rate)
+        yield self.settle(lambda: len(self.fanout) >= n)
+        received = len(self.fanout)
+        span = (self.fanout[-1] - started[0]) if self.fanout else 0
+        self._phase("fanout", started, 2 * received, dict(
+            sent=n, relayed=received,
+            relayed_per_sec=received / span if span else None))
+
+    @defer.inlineCallbacks
+    def stream(self):
+        n = self.options.tail
+        started = (time.time(), usage()[0])
+        extra = dict()
+        # a whole reply sends its first line, the rest waits for !more
+        for mode, wait in (("streamed", n), ("whole", 1)):
+            del self.tail[:]
+            start = time.time()
+            self.networks["bench-a"].inject(
+                MEMBERS[0], "#bench",
+                "!tail %d%s" % (n, " whole" if mode == "whole" else ""))
+            yield self.settle(lambda: len(self.tail) >= wait)
+            extra[mode] = dict(
+                lines=len(self.tail),
+                first_ms=(self.tail[0] - start) * 1000 if self.tail else None,
+                last_ms=(self.tail[-1] - start) * 1000 if self.tail else None)
+        self._phase("stream", started, n + 1, extra)
+
+    @defer.inlineCallbacks
+    def profile(self, method, path=""):
+        url = "http://127.0.0.1:%d/profile%s" % (self.controller, path)
+        response = yield Agent(reactor).request(method, url)
+        body = yield readBody(response)
+        if response.code != 200:
+            raise RuntimeError("%s %s: %s" % (method, url, body))
+        defer.returnValue(body)
+
+    @defer.inlineCallbacks
+    def ingest(self):
+        agent = Agent(reactor)
+        url = "http://127.0.0.1:%d/message" % self.controller
+        headers = Headers({"Content-Type": ["application/x-ndjson"]})
+        started = (time.time(), usage()[0])
+        accepted = 0
+        for b in range(self.options.batches):
+            body = "\n".join(json.dumps(dict(servername="bench-b",
+                                             channels=["#ingest"],
+                                             text=["alert %d/%d" % (b, i)]))
+                             for i in range(self.options.batch))
+            response = yield agent.request(
+                "POST", url, headers, FileBodyProducer(StringIO(body)))
+            reply = yield readBody(response)
+            if response.code == 200:
+                accepted += json.loads(reply)["accepted"]
+        duration = time.time() - started[0]
+        self._phase("ingest", started, accepted, dict(
+            posted=self.options.batches * self.options.batch,
+            accepted=accepted,
+            messages_per_sec=accepted / duration if duration else None))
+
+    @defer.inlineCallbacks
+    def run(self):
+        try:
+            yield self.wait_joined()
+            if self.options.profile:
+                yield self.profile("POST", "?threads=reactor&seconds=120")
+            yield self.latency()
+            yield self.fanout_phase()
+            if self.options.profile:
+                yield self.profile("DELETE")
+                summary = yield self.profile("GET")
+                self.results["profile"] = json.loads(summary)
+                dump = yield self.profile("GET", "/reactor.pstats")
+                with open(self.options.profile, "wb") as f:
+                    f.write(dump)
+            yield self.stream()
+            yield self.ingest()
+        except Exception:
+            log.err()
+        finally:
+            reactor.stop()
+
+    def report(self):
+        return dict(commit=commit(),
+                    timestamp=time.time(),
+                    options=vars(self.options),
+                    results=self.results)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--lines", type="int", default=1000)
+    parser.add_option("--rate", type="int", default=200,
+                      help="injected lines per second")
+    parser.add_option("--channels", type="int", default=300,
+                      help="extra channels to join")
+    parser.add_option("--tail", type="int", default=200,
+                      help="lines of the slow streaming webhook")
+    parser.add_option("--batches", type="int", default=20)
+    parser.add_option("--batch", type="int", default=500)
+    parser.add_option("--journal", default=None,
+                      help="journal outbound messages into this directory")
+    parser.add_option("--python", action="store_true", default=False,
+                      help="answer !time in process instead of by webhook")
+    parser.add_option("--profile", default=None,
+                      help="profile latency and fanout into this file")
+    parser.add_option("--output", default=None)
+    parser.add_option("--verbose", action="store_true", default=False)
+    options, args = parser.parse_args()
+
+    if options.verbose:
+        log.startLogging(sys.stderr)
+
+    bench = Bench(options)
+    config = bench.listen()
+    with tempfile.NamedTemporaryFile(suffix=".yaml", delete=False) as f:
+        f.write(safe_dump(config, default_flow_style=False))
+
+    try:
+        from sabo import setup
+        bench.started = time.time()
+        setup(f.name)
+        reactor.callWhenRunning(bench.run)
+        reactor.run()
+    finally:
+        os.unlink(f.name)
+
+    report = json.dumps(bench.report(), indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, "w") as out:
+            out.write(report + "\n")
+    else:
+        print report
+
+
+if __name__ == "__main__":
+    main()
+
+# vim: ts=4 sw=4 ai et
@@ -0,0 +1,186 @@
+# -*- mode: python -*-
+
+"""
+In-process stand-ins for the benchmark: a minimal IRC server speaking
+enough of the protocol for sabo's IRCClient (registration, JOIN, NAMES,
+PRIVMSG) and webhook services mimicking service/*.rpy without leaving
+localhost.
+
+"""
+
+from twisted.internet import reactor, protocol
+from twisted.protocols.basic import LineReceiver
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+from ujson import encode as json_encode, decode as json_decode
+
+import re
+import time
+
+URL_RE = re.compile("https?://[a-zA-Z0-9.@&=%+/:?-]+")
+
+
+class FakeIRCProtocol(LineReceiver):
+
+    delimiter = "\r\n"
+
+    def connectionMade(self):
+        self.nickname = None
+        self.channels = set()
+        self.factory.clients.append(self)
+
+    def connectionLost(self, reason):
+        if self in self.factory.clients:
+            self.factory.clients.remove(self)
+
+    def reply(self, line):
+        self.sendLine(":%s %s" % (self.factory.name, line))
+
+    def lineReceived(self, line):
+        self.factory.lines_in += 1
+        prefix, command, params = self._parse(line)
+        handler = getattr(self, "irc_%s" % command, None)
+        if handler is not None:
+            handler(params)
+
+    def _parse(self, line):
+        prefix = None
+        if line.startswith(":"):
+            prefix, line = line[1:].split(" ", 1)
+        if " :" in line:
+            line, trailing = line.split(" :", 1)
+            params = line.split() + [trailing]
+        else:
+            params = line.split()
+        return prefix, params[0].upper(), params[1:]
+
+    def irc_NICK(self, params):
+        self.nickname = params[0]
+
+    def irc_USER(self, params):
+        self.reply("001 %s :Welcome to the benchmark network" % self.nickname)
+        self.reply("005 %s %s :are supported by this server" %
+                   (self.nickname, " ".join(self.factory.isupport)))
+        self.reply("422 %s :MOTD File is missing" % self.nickname)
+
+    def irc_JOIN(self, params):
+        self.factory.join_lines += 1
+        for channel in params[0].split(","):
+            self.channels.add(channel.lower())
+            self.sendLine(":%s!bench@localhost JOIN %s" %
+                          (self.nickname, channel))
+            names = [self.nickname] + self.factory.members
+            self.reply("353 %s = %s :%s" %
+                       (self.nickname, channel, " ".join(names)))
+            self.reply("366 %s %s :End of /NAMES list." %
+                       (self.nickname, channel))
+
+    def irc_PING(self, params):
+        self.reply("PONG %s" % " ".join(params))
+
+    def irc_PRIVMSG(self, params):
+        now = time.time()
+        for target in params[0].split(","):
+            self.factory.received(target, params[1], now)
+
+    def inject(self, user, channel, text):
+        self.sendLine(":%s!bench@localhost PRIVMSG %s :%s" %
+                      (user, channel, text))
+
+
+class FakeIRCFactory(protocol.ServerFactory):
+
+    protocol = FakeIRCProtocol
+
+    def __init__(self, name, members=(), isupport=()):
+        self.name = name
+        self.members = list(members)
+        self.isupport = list(isupport)
+        self.clients = list()
+        self.lines_in = 0
+        self.join_lines = 0
+        self.listeners = list()
+
+    def received(self, target, text, when):
+        for listener in self.listeners:
+            listener(self.name, target, text, when)
+
+    def inject(self, user, channel, text):
+        for client in self.clients:
+            client.inject(user, channel, text)
+
+    def joined(self, channel):
+        return any(channel.lower() in x.channels for x in self.clients)
+
+
+class TimePage(Resource):
+    """time.rpy stand-in echoing the request text back"""
+
+    isLeaf = True
+
+    def render_POST(self, request):
+        request.content.seek(0, 0)
+        data = json_decode(request.content.read())
+        return json_encode(dict(text=[u"%s %s" % (time.strftime("%X"),
+                                                  data["text"])]))
+
+
+class TinyURLPage(Resource):
+    """tinyurl.rpy stand-in shortening urls without leaving localhost"""
+
+    isLeaf = True
+
+    def render_POST(self, request):
+        request.content.seek(0, 0)
+        text = request.content.read()
+        return URL_RE.sub(lambda m: "http://tiny.test/%x" %
+                          (hash(m.group(0)) & 0xffffff), text)
+
+
+class TailPage(Resource):
+    """a slow handler producing `!tail <n> [whole]' lines, one every
+    interval, streamed as newline-delimited JSON unless asked for whole"""
+
+    isLeaf = True
+    interval = 0.01
+
+    def render_POST(self, request):
+        request.content.seek(0, 0)
+        args = json_decode(request.content.read())["text"].split()
+        count, whole = int(args[1]), "whole" in args[2:]
+        lines = list()
+
+        def __next(i):
+            if request.finished or request._disconnected:
+                return
+            if i == count:
+                if whole:
+                    request.write(json_encode(dict(text=lines)))
+                request.finish()
+                return
+            line = "tail %d/%d" % (i, count)
+            if whole:
+                lines.append(line)
+            else:
+                request.write(json_encode(dict(text=[line])) + "\n")
+            reactor.callLater(self.interval, __next, i + 1)
+
+        if not whole:
+            request.setHeader("Content-Type", "application/x-ndjson")
+        __next(0)
+        return NOT_DONE_YET
+
+
+def time_plugin(message, context):
+    """TimePage as a `python:' handler"""
+    return dict(text=[u"%s %s" % (time.strftime("%X"), message["text"])])
+
+
+def webhooks():
+    root = Resource()
+    root.putChild("time.rpy", TimePage())
+    root.putChild("tinyurl.rpy", TinyURLPage())
+    root.putChild("tail.rpy", TailPage())
+    return root
+
+# vim: ts=4 sw=4 ai et
@@ -1,26 +1,76 @@
 from sabo.setting import init as init_setting
 from sabo.ircclient import IRCClientFactory
-from sabo.service import MessageService
-from twisted.web import resource, server
+from sabo.service import MessageService, MetricsService, IngestSite
+from sabo.service import ProfileService
+from sabo.profiler import Profiler
+from sabo.webclient import WebClient
+from sabo.workers import WorkerPool
+from sabo import logger
+from twisted.web import resource
 from twisted.internet import reactor
 from twisted.python import log
 
-def start(yaml):
+
+def _init(yaml):
     init_setting(yaml)
 
     from sabo.setting import setting
 
-    # setup clients
+    logger.configure(setting.get("logging", None))
+    return setting
+
+
+def _connect(names, siblings, webclient, workers, link=None):
+    """connect servers, adding their factories to siblings"""
+    from sabo.setting import setting
+
+    # one server after the other, by name over all shards
+    interval = setting.get("connect_interval", 1)
+    order = sorted(setting["servers"].keys())
+    for name in names:
+        siblings[name] = f = IRCClientFactory(name, siblings,
+                                              webclient, workers)
+        f.link = link
+        delay = order.index(name) * interval
+        log.msg("Connecting to %s:%s in %.1fs" % (f.host, f.port, delay))
+        reactor.callLater(delay, reactor.connectTCP, f.host, f.port, f)
+
+
+def _listen(setting, clients, workers, shards=None):
+    """listen on the controller port"""
+    root = resource.Resource()
+    message = MessageService(clients)
+    root.putChild("message", message)
+    root.putChild("metrics", MetricsService(clients, workers, shards))
+    root.putChild("profile", ProfileService(Profiler(workers), shards))
+    site = IngestSite(root, {"/message": message})
+
+    reactor.listenTCP(setting["controller"]["port"], site,
+                      interface=setting["controller"].get("host", ""))
+
+
+def _setup(setting):
+    # setup clients sharing one http connection pool and worker pool
+    webclient = WebClient(setting.get("http", None))
+    workers = WorkerPool(setting.get("workers", None))
     siblings = dict()
-    for name in setting["servers"].keys():
-        siblings[name] = f = IRCClientFactory(name, siblings)
-        log.msg("Connecting to %s:%s" % (f.host, f.port))
-        reactor.connectTCP(f.host, f.port, f)
+    _connect(setting["servers"].keys(), siblings, webclient, workers)
 
     # setup controlling server
-    root = resource.Resource()
-    root.putChild("message", MessageService(siblings))
-    site = server.Site(root)
+    _listen(setting, siblings, workers)
+    return siblings
 
-    reactor.listenTCP(setting["controller"]["port"], site)
+
+def setup(yaml):
+    """connect all servers and listen on the controller port"""
+    return _setup(_init(yaml))
+
+
+def start(yaml):
+    from sabo.shard import processes, coordinate
+    setting = _init(yaml)
+    if processes(setting) > 1:
+        coordinate(yaml, setting)
+    else:
+        _setup(setting)
     reactor.run()
@@ -0,0 +1,102 @@
+# -*- mode: python -*-
+
+"""
+Caches for webhook results.
+
+LRUCache is a plain size-bounded mapping. ResponseCache adds a TTL and
+coalesces concurrent lookups of the same key so that they share a single
+outstanding request.
+
+"""
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+from collections import OrderedDict
+
+import time
+
+__all__ = ["LRUCache", "ResponseCache"]
+
+KEY_FIELDS = ("servername", "user", "channel", "text")
+
+
+class LRUCache(object):
+
+    def __init__(self, size=128):
+        self.size = size
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        if key not in self._items:
+            return default
+        value = self._items.pop(key)
+        self._items[key] = value
+        return value
+
+    def set(self, key, value):
+        if key in self._items:
+            del self._items[key]
+        elif len(self._items) >= self.size:
+            self._items.popitem(last=False)
+        self._items[key] = value
+
+    def clear(self):
+        self._items.clear()
+
+
+class ResponseCache(object):
+
+    def __init__(self, ttl=60, size=128, key=("text",)):
+        if isinstance(key, basestring):
+            key = key.split("+")
+        for field in key:
+            if field not in KEY_FIELDS:
+                raise ValueError("invalid cache key field: %s" % field)
+        self.ttl = ttl
+        self.fields = tuple(key)
+        self._entries = LRUCache(size)
+        self._pending = dict()
+
+    @classmethod
+    def from_config(cls, config):
+        if not isinstance(config, dict):
+            config = dict()
+        return cls(**config)
+
+    def key(self, **fields):
+        return tuple(fields[field] for field in self.fields)
+
+    def get(self, key, factory, *args, **kwargs):
+        """fire with the cached value or with what factory's Deferred yields"""
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.time():
+            return defer.succeed(entry[1])
+
+        if key in self._pending:
+            d = defer.Deferred()
+            self._pending[key].append(d)
+            return d
+
+        self._pending[key] = list()
+        d = defer.maybeDeferred(factory, *args, **kwargs)
+        d.addBoth(self._done, key)
+        return d
+
+    def _done(self, value, key):
+        waiters = self._pending.pop(key, ())
+        if isinstance(value, Failure):
+            for d in waiters:
+                d.errback(value)
+        else:
+            self._entries.set(key, (time.time() + self.ttl, value))
+            for d in waiters:
+                d.callback(value)
+        return value
+
+# vim: ts=4 sw=4 ai et
@@ -0,0 +1,95 @@
+# -*- mode: python -*-
+
+"""
+Context payload sent to webhook handlers.
+
+A handler lists the fields it needs under `context':
+
+  context: [nickname, roster]
+
+  nickname, servername, version   about the bot
+  channels                        the channel configuration
+  users                           {channel: {nick: {}}} of every channel
+  roster                          nicks of the current channel only
+
+Handlers without the list get the legacy payload (everything but
+`roster'). Each field is kept, as serialized JSON for webhooks and as is
+for python handlers, along with the version it was built from, and is
+only built again once the roster or the configuration changed.
+
+"""
+
+from ujson import encode as json_encode
+
+__all__ = ["ContextSnapshots", "CONTEXT_FIELDS", "LEGACY_FIELDS"]
+
+CONTEXT_FIELDS = ("nickname", "servername", "version", "channels", "users",
+                  "roster")
+LEGACY_FIELDS = ("nickname", "servername", "channels", "users", "version")
+
+
+class ContextSnapshots(object):
+
+    def __init__(self, roster):
+        self.roster = roster
+        self.values = dict()
+        self.version = 0
+        self._fragments = dict()
+        self._values = dict()
+
+    def update(self, **values):
+        """replace the configuration fields, invalidating their snapshots"""
+        self.values = values
+        self.version += 1
+
+    def _source(self, name, channel):
+        if name == "users":
+            return (name, None), self.roster.version
+        if name == "roster":
+            channel = channel.lower()
+            return (name, channel), self.roster.channel_version(channel)
+        return (name, None), self.version
+
+    def _build(self, name, channel):
+        if name == "users":
+            return self.roster.as_dict()
+        if name == "roster":
+            return sorted(self.roster.members(channel))
+        return self.values[name]
+
+    def value(self, name, channel):
+        key, version = self._source(name, channel)
+        cached = self._values.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        value = self._build(name, channel)
+        self._values[key] = (version, value)
+        return value
+
+    def as_dict(self, fields, channel):
+        """context dict holding `fields'"""
+        if fields is None:
+            fields = LEGACY_FIELDS
+        return dict((x, self.value(x, channel)) for x in fields)
+
+    def fragment(self, name, channel):
+        key, version = self._source(name, channel)
+        cached = self._fragments.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        data = json_encode(self.value(name, channel))
+        self._fragments[key] = (version, data)
+        return data
+
+    def forget(self, channel):
+        self._fragments.pop(("roster", channel.lower()), None)
+        self._values.pop(("roster", channel.lower()), None)
+
+    def payload(self, fields, channel):
+        """serialized context object holding `fields'"""
+        if fields is None:
+            fields = LEGACY_FIELDS
+        return "{%s}" % ",".join('"%s":%s' % (x, self.fragment(x, channel))
+                                 for x in fields)
+
+# vim: ts=4 sw=4 ai et
@@ -0,0 +1,125 @@
+# -*- mode: python -*-
+
+"""
+Handler dispatch tables.
+
+Handlers are indexed once at configuration load. `match_server` and
+`match_channel` are resolved lazily per (server, channel) and cached, so
+a message only walks the handlers that could fire for its channel. Within
+that candidate set, `match_text` patterns with a literal prefix (e.g.
+'^!time') are bucketed by their first byte and only tried when the text
+starts with that prefix.
+
+"""
+
+import re
+
+__all__ = ["DispatchTable", "literal_prefix"]
+
+_META = frozenset(".^$*+?{}[]\\|()")
+_OPTIONAL = frozenset("*?{")
+
+
+def literal_prefix(regex):
+    """return the literal string every text matched by `regex' starts with"""
+    if regex.flags & (re.IGNORECASE | re.VERBOSE):
+        return ""
+
+    pattern = regex.pattern
+    if "|" in pattern:
+        return ""
+    if pattern.startswith("^"):
+        pattern = pattern[1:]
+
+    prefix = list()
+    for c in pattern:
+        if c in _META:
+            # the quantified character is optional
+            if c in _OPTIONAL and prefix:
+                prefix.pop()
+            break
+        prefix.append(c)
+
+    prefix = "".join(prefix)
+    if isinstance(prefix, unicode):
+        prefix = prefix.encode("UTF-8")
+    return prefix
+
+
+class _CandidateSet(object):
+
+    def __init__(self, handlers, prefixes, indices):
+        self.handlers = handlers
+        self.prefixes = prefixes
+        self.indices = indices
+        self.always = list()
+        self.buckets = dict()
+        for index in indices:
+            prefix = prefixes[index]
+            if prefix:
+                self.buckets.setdefault(prefix[0], list()).append(index)
+            else:
+                self.always.append(index)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __iter__(self):
+        return (self.handlers[i] for i in self.indices)
+
+    def match(self, user, text):
+        """text must be UTF-8 encoded since regex in yaml are UTF-8"""
+        bucket = self.buckets.get(text[:1])
+        if bucket:
+            prefixes = self.prefixes
+            indices = [i for i in bucket if text.startswith(prefixes[i])]
+            if self.always:
+                indices = sorted(indices + self.always)
+        else:
+            indices = self.always
+
+        matched = list()
+        for index in indices:
+            h = self.handlers[index]
+            if "match_user" in h and not h["match_user"].match(user):
+                continue
+            if "match_text" in h and not h["match_text"].match(text):
+                continue
+            matched.append(h)
+
+        return matched
+
+
+class DispatchTable(object):
+
+    def __init__(self, handlers):
+        self.handlers = handlers
+        self.prefixes = [literal_prefix(h["match_text"])
+                         if "match_text" in h else ""
+                         for h in handlers]
+        self._candidates = dict()
+
+    def __len__(self):
+        return len(self.handlers)
+
+    def candidates(self, servername, channel):
+        index = (servername, channel)
+        if index in self._candidates:
+            return self._candidates[index]
+
+        indices = list()
+        for i, h in enumerate(self.handlers):
+            if "match_server" in h and not h["match_server"].match(servername):
+                continue
+            if "match_channel" in h and not h["match_channel"].match(channel):
+                continue
+            indices.append(i)
+
+        self._candidates[index] = c = \
+            _CandidateSet(self.handlers, self.prefixes, indices)
+        return c
+
+    def match(self, servername, user, channel, text):
+        return self.candidates(servername, channel).match(user, text)
+
+# vim: ts=4 sw=4 ai et
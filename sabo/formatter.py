@@ -0,0 +1,116 @@
+# -*- mode: python -*-
+
+"""
+Fitting outbound text into IRC lines.
+
+A line is at most 512 bytes including CRLF and the server relays our
+PRIVMSGs prefixed with nick!user@host, so the room left for text depends
+on the target and on our hostmask. Text is encoded in the target's
+encoding and split between characters, preferably at a space. Short
+lines are packed into one PRIVMSG joined by a separator, and targets
+sharing an encoding into one comma-separated target list. Channels to
+join are packed the same way into JOIN #a,#b,#c keyA,keyB lines.
+
+"""
+
+__all__ = ["text_budget", "split_text", "pack_lines", "group_targets",
+           "join_line"]
+
+MAX_LINE = 512
+
+# user and host of an unknown hostmask: 10 + "@" + 63
+USERHOST_ESTIMATE = 74
+
+
+def text_budget(nickname, target, userhost=None):
+    """bytes of text a PRIVMSG to target can carry"""
+    userhost = len(userhost) if userhost else USERHOST_ESTIMATE
+    # ":nick!user@host PRIVMSG target :text\r\n"
+    overhead = 1 + len(nickname) + 1 + userhost + 9 + len(target) + 2 + 2
+    return MAX_LINE - overhead
+
+
+def _prefix(text, encoding, budget):
+    """longest prefix of text whose encoding fits in budget bytes"""
+    n = min(len(text), budget)
+    while True:
+        data = text[:n].encode(encoding, "ignore")
+        if len(data) <= budget or n == 1:
+            return n, data
+        n = max(1, min(n - 1, n * budget // len(data)))
+
+
+def split_text(text, encoding, budget):
+    """encoded chunks of text of at most budget bytes each"""
+    # a target too long to leave room still gets a character per line
+    budget = max(budget, 1)
+    chunks = list()
+    while text:
+        n, data = _prefix(text, encoding, budget)
+        if n < len(text):
+            # break at a space in the second half if there is one
+            space = text.rfind(u" ", n // 2, n + 1)
+            if space > 0:
+                data = text[:space].encode(encoding, "ignore")
+                n = space + 1
+        text = text[n:]
+        if data:
+            chunks.append(data)
+    return chunks
+
+
+def pack_lines(lines, encoding, budget, separator=None):
+    """encode lines, splitting long ones and, given a separator, joining
+    short ones into as few lines as possible"""
+    packed = list()
+    if separator is not None:
+        separator = separator.encode(encoding, "ignore")
+    for line in lines:
+        for chunk in split_text(line.rstrip(u"\r"), encoding, budget):
+            if (separator is not None and packed and
+                len(packed[-1]) + len(separator) + len(chunk) <= budget):
+                packed[-1] += separator + chunk
+            else:
+                packed.append(chunk)
+    return packed
+
+
+def group_targets(targets, count, size=MAX_LINE // 4):
+    """comma-joined lists of at most count targets and size bytes"""
+    groups, group, length = list(), list(), 0
+    for target in targets:
+        if group and (len(group) >= count or
+                      length + 1 + len(target) > size):
+            groups.append(",".join(group))
+            group, length = list(), 0
+        length += len(target) + (1 if group else 0)
+        group.append(target)
+    if group:
+        groups.append(",".join(group))
+    return groups
+
+
+def join_line(channels, count):
+    """JOIN line for the first of at most count (channel, key) pairs that
+    fit into a line, and how many it takes. Keys are matched to channels
+    by position, so no channel with a key follows one without."""
+    names, keys, length = list(), list(), len("JOIN \r\n")
+    for channel, key in channels:
+        if names and (len(names) >= count or (key and len(keys) < len(names))):
+            break
+        more = len(channel) + (1 if names else 0)
+        if key:
+            # a space before the first key, a comma before the others
+            more += len(key) + 1
+        if names and length + more > MAX_LINE:
+            break
+        names.append(channel)
+        if key:
+            keys.append(key)
+        length += more
+    line = "JOIN " + ",".join(names)
+    if keys:
+        line += " " + ",".join(keys)
+    return line, len(names)
+
+# vim: ts=4 sw=4 ai et
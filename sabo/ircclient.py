@@ -9,30 +9,75 @@ return value format:
   "channels": ["channel1", "channel2"]
   "users": ["user1", "user2"]
 }
+
+or, as application/x-ndjson, one such object per line, each sent as soon
+as it arrived.
 """
 
-from twisted.internet import reactor, protocol, threads, defer
+from twisted.internet import reactor, protocol, defer
 from twisted.words.protocols import irc
-from twisted.web.client import getPage
 from twisted.python.failure import Failure
 from twisted.python import log
-from sabo.util import fix_message_encoding
+from sabo.util import fix_message_encoding, message_size
 from sabo.setting import ConfigError
+from sabo.metrics import metrics
+from sabo import logger
+from sabo.roster import Roster
+from sabo.context import ContextSnapshots
+from sabo.formatter import text_budget, pack_lines, group_targets
+from sabo.formatter import join_line
+from sabo.scheduler import TokenBucket, RateMeter, OutboundQueue
+from sabo.journal import Journal
+from collections import OrderedDict, deque
 from ujson import encode as json_encode, decode as json_decode
 from logging import WARN, DEBUG
 
+import os
 import re
 import sys
+import math
 import time
 import random
 import traceback
 
-__all__ = ['IRCClient', 'IRCClientFactory', 'ConfigError']
+__all__ = ['IRCClient', 'IRCClientFactory', 'ConfigError', 'reload_all',
+           'apply_setting']
+
+# connection states of IRCClientFactory
+CONNECTING = "connecting"
+REGISTERED = "registered"
+JOINED = "joined"
+BACKING_OFF = "backing-off"
+
+
+def reload_all(siblings):
+    """reload the configuration into the connections of this process,
+    return False if it did not change"""
+    from sabo.setting import read_setting
+    return apply_setting(siblings, read_setting())
+
+
+def apply_setting(siblings, state):
+    """make a configuration read by read_setting the running one of the
+    connections of this process, return False if it did not change"""
+    from sabo.setting import commit_setting
+    setting, changes = commit_setting(state)
+    if changes is None:
+        log.msg("configuration unchanged")
+        return False
+
+    logger.configure(setting.get("logging", None))
+
+    # swap tables of all siblings at once
+    for factory in siblings.values():
+        factory.reconfigure(setting, changes)
+    return True
 
 
 class IRCClient(irc.IRCClient):
 
     EXPAND_RE = re.compile("%{(\w+)}")
+    ENCODING_CACHE_SIZE = 4096
 
     nickmame = "sabo"
     realname = "Robert Sabo"
@@ -47,7 +92,6 @@ class IRCClient(irc.IRCClient):
         try:
             self.servername = servername
             self.server = setting["servers"][self.servername]
-            self.lineRate = self.server.get("linerate", None)
             self.schedule_interval = self.server.get("schedule_interval", 0.3)
             self.siblings = self.factory.siblings
             self.userinfo = setting["users"]
@@ -57,8 +101,13 @@ class IRCClient(irc.IRCClient):
             self.password = self.server.get("password", None)
             self.channels = setting["channels"]
             self.handlers = setting["handlers"]
+            self.dispatch = setting["dispatch"]
+            self.ratelimit = setting["ratelimit"]
             self.last_schedule = time.time()
 
+            self._queue_limits()
+            self._line_options()
+
             if "ignore_target" in self.server:
                 self.ignore_target = re.compile(self.server["ignore_target"])
             else:
@@ -67,9 +116,21 @@ class IRCClient(irc.IRCClient):
         except Exception as e:
             raise ConfigError("malformed configuration: %s" % str(e))
 
-        self._mq = list()
-        self._rq = dict()
-        self._users = dict()
+        # lines are paced by the token bucket instead of irc.IRCClient
+        self.lineRate = None
+        self._bucket = TokenBucket(*self._flood_limits())
+        self._schedule_call = None
+        self._labels = (("server", self.servername),)
+        self._drain = RateMeter()
+        self._mq = OutboundQueue()
+        self._rq = OrderedDict()
+        self._users = Roster()
+        self._context = ContextSnapshots(self._users)
+        self._encodings = dict()
+        self._pending_joins = set()
+        self._joins = deque()
+        self._join_wait = None
+        self._userhost = None
 
         self._reload_context()
 
@@ -84,23 +145,63 @@ class IRCClient(irc.IRCClient):
             users=self._users,
             channels=self.channels,
             version="%s/%s" % (self.versionName, self.versionNum))
+        self._context.update(nickname=self.nickname,
+                             servername=self.servername,
+                             channels=self.channels,
+                             version=self.context["version"])
+
+    def _reload(self, state):
+        """reload reloadable settings of all connections :)"""
+        if apply_setting(self.siblings, state) and \
+           self.factory.link is not None:
+            # let the other shards follow
+            self.factory.link.reloaded()
+
+    def reconfigure(self, setting, changes):
+        if self.servername not in setting["servers"]:
+            log.msg("server %s removed, keeping its settings" %
+                    self.servername, level=WARN)
+            return
 
-    def _reload(self):
-        """reload reloadable settings :)"""
-        from sabo.setting import reload_setting
-        try:
-            setting = reload_setting()
-            self.server = setting["servers"][self.servername]
-            self.userinfo = setting["users"]
-            self.lineRate = self.server.get("linerate", None)
-            self.default_encoding = setting["servers"].get("encoding", "UTF-8")
-            self.channels = setting["channels"]
-            self.handlers = setting["handlers"]
-            self._reload_context()
-            self.signedOn()
-            self.schedule()
-        except Exception as e:
-            raise ConfigError("malformed configuration: %s" % str(e))
+        self.server = setting["servers"][self.servername]
+        self.userinfo = setting["users"]
+        self._bucket.update(*self._flood_limits())
+        self._queue_limits()
+        self._line_options()
+        self.default_encoding = self.server.get("encoding", "UTF-8")
+        self.channels = setting["channels"]
+        self._encodings.clear()
+        self.handlers = setting["handlers"]
+        self.dispatch = setting["dispatch"]
+        self.ratelimit = setting["ratelimit"]
+        self._reload_context()
+
+        # join and part only what changed
+        self._join_channels(
+            [x for x in changes["added"] if x[0] == self.servername])
+        for servername, channel in changes["removed"]:
+            if servername == self.servername:
+                log.msg("part %s/%s" % (servername, channel))
+                self.leave(channel)
+        self.schedule()
+
+    def _queue_limits(self):
+        self.max_queue = self.server.get("max_queue", 1000)
+        self.max_queue_bytes = self.server.get("max_queue_bytes", 1 << 20)
+        self.max_more = self.server.get("max_more", 1000)
+
+    def _line_options(self):
+        # short lines are packed into one PRIVMSG when `pack' is on
+        if self.server.get("pack", False):
+            self.pack_separator = unicode(
+                self.server.get("pack_separator", u" | "))
+        else:
+            self.pack_separator = None
+
+    def _flood_limits(self):
+        linerate = self.server.get("linerate", None)
+        rate = 1.0 / linerate if linerate else None
+        return (rate, self.server.get("burst", 5))
 
     def _match_encoding(self, channel):
         for e in self.userinfo:
@@ -116,12 +217,24 @@ class IRCClient(irc.IRCClient):
 
         return self.default_encoding
 
-    def _decode(self, channel, msg):
-        index = (self.servername, channel)
-        if index in self.channels:
-            return msg.decode(self.channels[index]["encoding"], "ignore")
+    def _target_encoding(self, target):
+        """cached encoding of a channel or user on this server"""
+        if target in self._encodings:
+            return self._encodings[target]
+
+        index = (self.servername, target)
+        if index in self.channels and "encoding" in self.channels[index]:
+            encoding = self.channels[index]["encoding"]
         else:
-            return msg.decode(self._match_encoding(channel), "ignore")
+            encoding = self._match_encoding(target)
+
+        if len(self._encodings) >= self.ENCODING_CACHE_SIZE:
+            self._encodings.clear()
+        self._encodings[target] = encoding
+        return encoding
+
+    def _decode(self, channel, msg):
+        return msg.decode(self._target_encoding(channel), "ignore")
 
     def _encode(self, channel, msg):
         try:
@@ -131,11 +244,7 @@ class IRCClient(irc.IRCClient):
             raise
 
     def __encode(self, channel, msg):
-        index = (self.servername, channel)
-        if index in self.channels:
-            return msg.encode(self.channels[index]["encoding"], "ignore")
-        else:
-            return msg.encode(self._match_encoding(channel), "ignore")
+        return msg.encode(self._target_encoding(channel), "ignore")
 
     def _complain(self, err):
         log.msg(str(err), level=WARN)
@@ -155,58 +264,122 @@ class IRCClient(irc.IRCClient):
     # Message Queue Manipulation
     ##########################################################################
 
-    def mq_merge(self, data):
+    def _mq_key(self, data):
+        return (tuple(data.get("channels", ())), tuple(data.get("users", ())))
 
-        if not self._mq: return False
+    def mq_size(self, data):
+        return message_size(data)
+
+    def mq_retry_after(self, count=1, size=0, priority=0):
+        """seconds until count messages of size bytes fit, 0 if they do"""
+        lowest = self._mq.lowest()
+        if lowest is not None and priority > lowest:
+            # can take the place of lower priority messages
+            return 0
+
+        excess = len(self._mq) + count - self.max_queue
+        over = self._mq.bytes + size - self.max_queue_bytes
+        if over > 0:
+            average = float(self._mq.bytes) / len(self._mq) \
+                if self._mq else size / float(count)
+            excess = max(excess, int(math.ceil(over / max(average, 1))))
+        if excess <= 0:
+            return 0
+
+        return int(math.ceil(excess / self.mq_rate()))
+
+    def mq_rate(self):
+        """messages per second the queue drains at"""
+        return self._drain.rate() or self._bucket.rate or \
+            1.0 / self.schedule_interval
+
+    def mq_merge(self, data, size, priority):
+
+        key = self._mq_key(data)
+        last = self._mq.tail(key, priority)
+        if last is None: return False
 
         now = time.time()
-        last = self._mq[-1]
         interval = now - last["start_time"]
 
         if interval > self.schedule_interval: return False
+        if "lines" in last: return False
         if len(last["text"]) > 1 or len(data["text"]) > 1:
             return False
-        if "channels" in data and data["channels"] != last["channels"]:
-            return False
-        if "users" in data and data["users"] != last["users"]:
-            return False
 
-        log.msg("mq_append[%s]: (merge) %s" % (self.servername, str(data)),
-                level=DEBUG)
+        logger.debug("mq_append[%s]: (merge) %s", self.servername, data)
 
-        self._mq[-1]["text"][0] += "\n" + data["text"][0]
+        self.factory.journal_append(data)
+        if "journal" in data:
+            last.setdefault("journal", list()).extend(data["journal"])
+        last["text"][0] += "\n" + data["text"][0]
+        self._mq.grow(key, size, priority)
 
         return True
 
     def mq_append(self, data):
+        """queue data, return False if the queue is full"""
         if not isinstance(data, dict):
             self._complain("mq data is not dict:")
             #traceback.print_stack()
-            return
+            return False
 
-        if self.mq_merge(data) == True:
-            return
+        # nothing to send, skip it quietly
+        if not data.get("text", None) and not data.get("lines", None):
+            logger.debug("mq_append[%s]: (no text) %s", self.servername, data)
+            self.factory.journal_done(data)
+            return True
 
-        log.msg("mq_append[%s]: (new) %s" % (self.servername, str(data)),
-                level=DEBUG)
+        size = self.mq_size(data)
+        priority = data.get("priority", 0)
+
+        if self.mq_merge(data, size, priority) == True:
+            return True
+
+        if (len(self._mq) >= self.max_queue or
+            self._mq.bytes + size > self.max_queue_bytes):
+            lowest = self._mq.lowest()
+            if lowest is not None and priority > lowest:
+                self.factory.journal_done(self._mq.evict())
+            else:
+                self._complain("mq[%s] is full, message dropped" %
+                               self.servername)
+                self.factory.journal_done(data)
+                return False
+
+        logger.debug("mq_append[%s]: (new) %s", self.servername, data)
+        self.factory.journal_append(data)
         data["start_time"] = time.time()
-        self._mq.append(data)
+        self._mq.push(self._mq_key(data), data, size, priority)
+        return True
+
+    def mq_extend(self, messages):
+        for data in messages:
+            self.mq_append(data)
 
     def rq_append(self, target, data):
-        log.msg("rq_append[%s@%s]: %s" % (target, self.servername, str(data)),
-                level=DEBUG)
+        logger.debug("rq_append[%s@%s]: %s", target, self.servername, data)
+        if target in self._rq:
+            del self._rq[target]
+        elif len(self._rq) >= self.max_more:
+            self._rq.popitem(last=False)
         self._rq[target] = data
 
     def rq_send(self, target):
-        log.msg("rq_send[%s]" % target, level=DEBUG)
+        logger.debug("rq_send[%s]", target)
         if target not in self._rq:
             return
         message = dict(self._rq[target])
         del self._rq[target]
+        # the first page was done with, journal the rest anew
+        message.pop("journal", None)
+        message.pop("lines", None)
+        message.pop("mq_key", None)
         self.mq_append(message)
         self.schedule()
 
     def _send_text(self, message):
+        """PRIVMSG lines of the next page of message"""
         text = unicode(message["text"][0])
         message["text"] = message["text"][1:]
         nrest = len(message["text"])
@@ -214,6 +387,20 @@ class IRCClient(irc.IRCClient):
         if nrest > 0:
             text += u" ...(%d more)" % nrest
 
+        # format once per encoding and room left, share among targets
+        lines = text.split(u"\n")
+        formatted = dict()
+
+        def encode_line(encoding, targets):
+            key = (encoding,
+                   text_budget(self.nickname, targets, self._userhost))
+            if key not in formatted:
+                formatted[key] = pack_lines(lines, key[0], key[1],
+                                            self.pack_separator)
+            return formatted[key]
+
+        targets = list()
+
         if "channels" in message and isinstance(message["channels"], list):
             random.shuffle(message["channels"])
             for channel in message["channels"]:
@@ -226,16 +413,15 @@ class IRCClient(irc.IRCClient):
                 if channel.endswith("*"):
                     if not "users" in message:
                         message["users"] = list()
-                    expanded_users = self._users[channel.rstrip("*")].keys()
+                    expanded_users = self._users.members(channel.rstrip("*"))
                     message["users"].extend(expanded_users)
                     continue
 
-                encode_text = self._encode(channel, text)
                 if nrest > 0:
                     self.rq_append(channel, message)
                 if self.ignore_target and self.ignore_target.match(channel):
                     continue
-                self.msg(channel, encode_text)
+                targets.append(channel)
 
         if "users" in message and isinstance(message["users"], list):
             random.shuffle(message["users"])
@@ -246,58 +432,157 @@ class IRCClient(irc.IRCClient):
                     and message["from_user"] == user):
                     continue
 
-                encode_text = self._encode(user, text)
                 if nrest > 0:
                     self.rq_append(user, message)
                 if self.ignore_target and self.ignore_target.match(user):
                     continue
-                self.msg(user, encode_text)
+                targets.append(user)
+
+        # one PRIVMSG per group of targets sharing an encoding
+        groups, seen = OrderedDict(), set()
+        for target in targets:
+            if target not in seen:
+                seen.add(target)
+                groups.setdefault(self._target_encoding(target),
+                                  list()).append(target)
+        count = self._max_targets()
+        privmsgs = list()
+        for encoding, members in groups.items():
+            for group in group_targets(members, count):
+                privmsgs.extend(self._msg_lines(group,
+                                                encode_line(encoding, group)))
+        return privmsgs
+
+    def _max_targets(self):
+        """targets a PRIVMSG may carry as advertised by ISUPPORT"""
+        count = 1
+        supported = getattr(self, "supported", None)
+        if supported is not None:
+            targmax = supported.getFeature("TARGMAX") or dict()
+            maxtargets = supported.getFeature("MAXTARGETS")
+            if "PRIVMSG" in targmax:
+                # no value means no limit
+                count = targmax["PRIVMSG"] or sys.maxint
+            elif maxtargets:
+                # a bare token means no limit
+                count = int(maxtargets[0]) if maxtargets[0] else sys.maxint
+        return min(count, self.server.get("max_targets", sys.maxint))
+
+    def _max_joins(self):
+        """channels a JOIN may carry, bounded by the line length only
+        unless TARGMAX or the server option max_joins tells otherwise"""
+        count = self.server.get("max_joins", sys.maxint)
+        supported = getattr(self, "supported", None)
+        if supported is not None:
+            targmax = supported.getFeature("TARGMAX") or dict()
+            count = min(count, targmax.get("JOIN", None) or sys.maxint)
+        return count
+
+    def _send_join(self):
+        line, count = join_line(self._joins, self._max_joins())
+        for i in xrange(count):
+            self._joins.popleft()
+        self.sendLine(line)
+
+    def _msg_lines(self, target, lines):
+        return ["PRIVMSG %s :%s" % (target, line) for line in lines]
 
     def _send(self, message):
-        if "text" in message:
-            return self._send_text(message)
+        """write the lines of message the line budget allows, return
+        False if some are left for its next turn"""
+        if "lines" not in message:
+            message["lines"] = deque(self._send_text(message)
+                                     if "text" in message else ())
+        lines = message["lines"]
+        while lines and self._bucket.delay() <= 0:
+            self.sendLine(lines.popleft())
+        return not lines
+
+    def _arm(self, delay):
+        self._schedule_call = reactor.callLater(delay, self.schedule)
 
     def schedule(self):
+        # only one timer is armed per connection
+        if self._schedule_call is not None and self._schedule_call.active():
+            return
+        self._schedule_call = None
+
+        # hold messages until the server accepts them
+        if self.factory.state not in (REGISTERED, JOINED):
+            return
+
         now = time.time()
-        if now - self.last_schedule  < self.schedule_interval:
-            elapsed = now - self.last_schedule
-            reactor.callLater(self.schedule_interval - elapsed, self.schedule)
+        elapsed = now - self.last_schedule
+        if elapsed < self.schedule_interval:
+            self._arm(self.schedule_interval - elapsed)
             return
         self.last_schedule = now
-        while self._mq:
-            message = self._mq.pop(0)
-            self._send(message)
+        while self._joins or self._mq:
+            delay = self._bucket.delay()
+            if delay > 0:
+                self._arm(delay)
+                return
+            # join before talking to the channels
+            if self._join_wait is not None:
+                return
+            if self._joins:
+                self._send_join()
+                continue
+            message = self._mq.pop()
+            if "lines" not in message:
+                message["mq_key"] = self._mq_key(message)
+                metrics.observe("sabo_queued_seconds", self._labels,
+                                time.time() - message["start_time"])
+            if not self._send(message):
+                # the rest waits behind the other targets
+                self._mq.requeue(message["mq_key"], message,
+                                 self.mq_size(message),
+                                 message.get("priority", 0))
+                continue
+            self.factory.journal_done(message)
+            self._drain.mark()
 
     ##########################################################################
     # handler infrastructure
     ##########################################################################
 
-    def _match(self, h, servername, user, channel, text):
-
-        if "match_server" in h and not h["match_server"].match(servername):
-            log.msg("match server `%s' with `%s' failed " % \
-                (h["match_server"].pattern, servername), level=DEBUG)
-            return False
-
-        if "match_channel" in h and not h["match_channel"].match(channel):
-            log.msg("match channel `%s' with `%s' failed " % \
-                (h["match_channel"].pattern, channel), level=DEBUG)
-            return False
-
-        if "match_user" in h and not h["match_user"].match(user):
-            log.msg("match user `%s' with `%s' failed " % \
-                (h["match_user"].pattern, user), level=DEBUG)
-            return False
-
+    def _match(self, event, user, channel, text):
+        start = time.time()
         # use UTF-8 since regex in yaml are UTF-8
         text = text.encode("UTF-8")
-        if "match_text" in h and not h["match_text"].match(text):
-            log.msg("match text `%s' with `%s' failed " % \
-                (h["match_text"].pattern, text), level=DEBUG)
-            return False
+        matched = self.dispatch[event].match(self.servername, user,
+                                            channel, text)
+        metrics.observe("sabo_match_seconds", self._labels,
+                        time.time() - start)
+        if logger.enabled(DEBUG):
+            for h in matched:
+                logger.debug("text matched: %s", h)
+        return matched
+
+    def _admit(self, handlers, user, channel):
+        """handlers the rate limits let this trigger through"""
+        if not handlers:
+            return handlers
 
-        log.msg("text matched: %s" % str(h))
-        return True
+        now = time.time()
+        # relays pass chat on, only commands count against the nick
+        if (self.ratelimit is not None and
+            any("redirect" not in h for h in handlers) and
+            not self.ratelimit.allow((self.servername, user), now)):
+            metrics.inc("sabo_ratelimited_total",
+                        self._labels + (("limit", "user"),))
+            handlers = [h for h in handlers if "redirect" in h]
+
+        admitted = list()
+        for h in handlers:
+            limiter = h.get("ratelimit", None)
+            if (limiter is not None and not limiter.allow(
+                    limiter.key(self.servername, user, channel), now)):
+                metrics.inc("sabo_ratelimited_total", self._labels +
+                            (("limit", h.get("name", limiter.per)),))
+                continue
+            admitted.append(h)
+        return admitted
 
     def _handled(self, value):
 
@@ -309,9 +594,7 @@ class IRCClient(irc.IRCClient):
             return
 
         if "servername" in value and value["servername"] != self.servername:
-            p = self.siblings[servername].protocol
-            p.mq_append(value)
-            p.schedule()
+            self.siblings[value["servername"]].enqueue([value])
         else:
             self.mq_append(value)
             self.schedule()
@@ -322,19 +605,124 @@ class IRCClient(irc.IRCClient):
         else:
             return ([], [channel])
 
+    def _http_post(self, h, postdata, received=None):
+        labels = self._labels + (("handler", h.get("name", h["http"])),)
+        start = time.time()
+
+        def __done(value):
+            metrics.observe("sabo_webhook_seconds", labels,
+                            time.time() - start)
+            if isinstance(value, Failure):
+                metrics.inc("sabo_webhook_errors_total", labels)
+            return value
+
+        def __received(data):
+            if not first:
+                first.append(time.time())
+                metrics.observe("sabo_webhook_first_seconds", labels,
+                                first[0] - start)
+            received(data)
+
+        webclient = self.factory.webclient
+        if received is None:
+            d = webclient.post(h["http"], postdata, h.get("timeout", None),
+                               h.get("connect_timeout", None))
+        else:
+            first = list()
+            d = webclient.stream(h["http"], postdata, __received,
+                                 h.get("timeout", None),
+                                 h.get("connect_timeout", None))
+        d.addBoth(__done)
+        return d
+
+    def _http_request(self, h, user, channel, text, received):
+        """post to a webhook, calling received with each message of the
+        response as it arrives"""
+
+        def __post(received):
+            context = self._context.payload(h.get("context"), channel)
+            postdata = '{"servername":%s,"user":%s,"channel":%s,' \
+                '"text":%s,"context":%s}' % \
+                (json_encode(self.servername), json_encode(user),
+                 json_encode(channel), json_encode(text), context)
+            return self._http_post(h, postdata, received)
+
+        if "cache" not in h:
+            return __post(received)
+
+        def __collect():
+            records = list()
+            d = __post(records.append)
+            d.addCallback(lambda _: records)
+            return d
+
+        def __replay(records):
+            for x in records:
+                received(x)
+            return len(records)
+
+        # identical requests share the cached or in-flight response
+        cache = h["cache"]
+        key = cache.key(servername=self.servername, user=user,
+                        channel=channel, text=text)
+        d = cache.get(key, __collect)
+        d.addCallback(__replay)
+        return d
+
     def _http_done(self, message, user, channel):
-        message = fix_message_encoding(json_decode(message))
+        return self._reply(json_decode(message), user, channel)
+
+    def _http_received(self, message, user, channel):
+        """queue one message of a webhook response"""
+        d = defer.maybeDeferred(self._http_done, message, user, channel)
+        d.addBoth(self._handled)
+
+    def _reply(self, message, user, channel):
+        if not message:
+            return None
+        if isinstance(message, basestring):
+            message = dict(text=message.splitlines())
+        message = fix_message_encoding(message)
         if "users" not in message and "channels" not in message:
             message["users"], message["channels"] = \
               self._default_target(user, channel)
         return message
 
+    def _python_call(self, h, user, channel, text):
+        """call a python handler with what a webhook would be posted"""
+        message = dict(servername=self.servername, user=user,
+                       channel=channel, text=text)
+        context = self._context.as_dict(h.get("context", None), channel)
+        name = h.get("name", h["python"].__name__)
+        labels = self._labels + (("handler", name),)
+        start = time.time()
+
+        def __done(value):
+            metrics.observe("sabo_plugin_seconds", labels,
+                            time.time() - start)
+            if isinstance(value, Failure):
+                metrics.inc("sabo_plugin_errors_total", labels)
+            return value
+
+        d = self._call(h, h["python"], message, context)
+        d.addBoth(__done)
+        return d
+
     def _execute_builtin(self, h, user, channel, text):
         if h["builtin"] == "reload":
             users, channels = self._default_target(user, channel)
 
-            try:
-                self._reload()
+            def __done(state):
+                try:
+                    if isinstance(state, Failure):
+                        state.raiseException()
+                    if state is None:
+                        raise ConfigError("worker pool is full")
+                    self._reload(state)
+                except Exception as e:
+                    log.msg(str(e))
+                    return dict(users=users, channels=channels,
+                                text=["failed!"])
                 num_handlers = reduce(lambda x, y: x + y,
                                       map(lambda x: len(x),
                                           self.handlers.values()))
@@ -342,13 +730,16 @@ class IRCClient(irc.IRCClient):
                     (len(self.siblings),
                      len(self.channels),
                      num_handlers,
-                    str(self.lineRate))
+                    str(self.server.get("linerate", None)))
                 return dict(users=users, channels=channels,
                             text=["reloaded successfully" + status])
-            except Exception as e:
-                log.msg(str(e))
-                return dict(users=users, channels=channels,
-                            text=["failed!"])
+
+            # only reading the configuration may go to the worker pool,
+            # it is applied on the reactor thread
+            from sabo.setting import read_setting
+            d = self._call(h, read_setting)
+            d.addBoth(__done)
+            return d
         elif h["builtin"] == "more":
             target = (channel, user)[channel == self.nickname]
             self.rq_send(target)
@@ -357,27 +748,18 @@ class IRCClient(irc.IRCClient):
 
     def _redirect_rewrite(self, h, text):
 
-        d = defer.succeed(text)
-
         if "rewrites" not in h:
-            return d
-
-        for rule in h["rewrites"]:
-            if "match_text" not in rule:
-                continue
+            return defer.succeed(text)
 
-            if not rule["match_text"].search(text):
-                continue
+        start = time.time()
 
-            if "http" in rule:
-                d.addCallback(lambda x: getPage(rule["http"],
-                                                method="POST",
-                                                postdata=text.encode("UTF-8")))
-            elif "text" in rule:
-                d.addCallback(lambda x:
-                              rule["match_text"].sub(rule["text"], text))
+        def __done(value):
+            metrics.observe("sabo_rewrite_seconds", self._labels,
+                            time.time() - start)
+            return value
 
-        #d.addCallback(lambda x: x.decode("UTF-8"))
+        d = h["rewrites"].run(text, self._http_post)
+        d.addBoth(__done)
         return d
 
     def _redirect(self, value, h, user, channel, text):
@@ -398,8 +780,7 @@ class IRCClient(irc.IRCClient):
               (unicode(user), unicode(self.servername), unicode(channel))
 
         for servername, rchannel in items:
-            log.msg("%s:%s/%s -> %s" % \
-                    (servername, channel, user, rchannel), level=DEBUG)
+            logger.debug("%s:%s/%s -> %s", servername, channel, user, rchannel)
             if servername == self.servername:
                 local_channels.append(rchannel)
             elif servername in self.siblings:
@@ -420,12 +801,13 @@ class IRCClient(irc.IRCClient):
         for servername, channels in remote_channels.items():
             reply = dict(channels=channels,
                          text=[u"%s%s" % (prefix, text)])
-            siblings = self.siblings.keys()
-            random.shuffle(siblings)
-            if servername in siblings:
-                p = self.siblings[servername].protocol
-                p.mq_append(reply)
-                p.schedule()
+            self.siblings[servername].enqueue([reply])
+
+    def _call(self, h, f, *args):
+        """run f on the reactor unless the handler is marked blocking"""
+        if h.get("blocking", False):
+            return self.factory.workers.run(f, *args)
+        return defer.maybeDeferred(f, *args)
 
     def _dispatch(self, h, user, channel, text=""):
 
@@ -438,53 +820,96 @@ class IRCClient(irc.IRCClient):
             d.addBoth(self._handled)
 
         if "http" in h:
-            postdata = json_encode(dict(servername=self.servername,
-                                        user=user,
-                                        channel=channel,
-                                        context=self.context,
-                                        text=text))
-            d = getPage(h["http"], method="POST", postdata=postdata)
-            d.addCallback(self._http_done, user, channel)
+            d = self._http_request(h, user, channel, text,
+                                   lambda x: self._http_received(x, user,
+                                                                 channel))
+            d.addErrback(self._complain)
+
+        if "python" in h:
+            d = self._python_call(h, user, channel, text)
+            d.addCallback(self._reply, user, channel)
             d.addBoth(self._handled)
 
         if "builtin" in h:
-            d = threads.deferToThread(self._execute_builtin, h,
-                                      user, channel, text)
+            d = defer.maybeDeferred(self._execute_builtin, h, user, channel,
+                                    text)
             d.addBoth(self._handled)
 
         if "redirect" in h:
             d = self._redirect_rewrite(h, text)
-            d.addBoth(lambda x:
-                      threads.deferToThread(self._redirect,
-                                            x, h, user, channel, text))
+            d.addBoth(self._redirect, h, user, channel, text)
+            d.addErrback(self._complain)
 
     def lineReceived(self, line):
-        log.msg(">> %s" % str(line))
-        sys.stdout.flush()
+        logger.traffic(">>", line)
+        metrics.inc("sabo_lines_in_total", self._labels)
         irc.IRCClient.lineReceived(self, line)
 
     def sendLine(self, line):
-        log.msg("<< %s" % str(line))
+        logger.traffic("<<", line)
+        self._bucket.consume()
+        metrics.inc("sabo_lines_out_total", self._labels)
         irc.IRCClient.sendLine(self, line)
 
     ##########################################################################
     # Protocol event dealers
     ##########################################################################
 
-    def connectionMade(self):
-        self.factory.reconnect_delay = 1
-        return irc.IRCClient.connectionMade(self)
-
-    def signedOn(self):
-        for index, value in self.channels.items():
+    def connectionLost(self, reason):
+        if self._schedule_call is not None and self._schedule_call.active():
+            self._schedule_call.cancel()
+        self._schedule_call = None
+        if self._join_wait is not None and self._join_wait.active():
+            self._join_wait.cancel()
+        self._join_wait = None
+        return irc.IRCClient.connectionLost(self, reason)
+
+    def _join_channels(self, indexes=None):
+        """queue JOINs, sent packed and paced by schedule()"""
+        if indexes is None:
+            indexes = self.channels.keys()
+        keyed, unkeyed = list(), list()
+        for index in indexes:
             servername, channel = index
             if not servername == self.servername:
                 continue
-            log.msg("join in %s/%s" % (servername, channel))
-            if "password" in value:
-                self.join(channel, value["password"])
-            else:
-                self.join(channel)
+            key = self.channels[index].get("password", None)
+            if channel[0] not in irc.CHANNEL_PREFIXES:
+                channel = "#" + channel
+            self._pending_joins.add(channel.lower())
+            if isinstance(channel, unicode):
+                channel = self._encode(channel, channel)
+            if isinstance(key, unicode):
+                key = key.encode(self.default_encoding, "ignore")
+            (keyed if key else unkeyed).append((channel, key))
+        if keyed or unkeyed:
+            log.msg("joining %d channels in %s" %
+                    (len(keyed) + len(unkeyed), self.servername))
+        # channels with keys first so that they share lines
+        self._joins.extend(keyed + unkeyed)
+
+    def signedOn(self):
+        self.factory.registered()
+        self._join_channels()
+        self.mq_extend(self.factory.release())
+        # ISUPPORT follows the welcome, join once the MOTD is over
+        self._join_wait = reactor.callLater(
+            self.server.get("join_wait", 5), self._end_of_motd)
+
+    def _end_of_motd(self):
+        if self._join_wait is None:
+            return
+        if self._join_wait.active():
+            self._join_wait.cancel()
+        self._join_wait = None
+        self.schedule()
+
+    def irc_RPL_ENDOFMOTD(self, prefix, params):
+        irc.IRCClient.irc_RPL_ENDOFMOTD(self, prefix, params)
+        self._end_of_motd()
+
+    def irc_ERR_NOMOTD(self, prefix, params):
+        self._end_of_motd()
 
     def _privmsg(self, user, channel, msg):
         text = self._decode(channel, msg)
@@ -493,102 +918,229 @@ class IRCClient(irc.IRCClient):
         if user.index("!") > -1:
             user = user.split("!")[0]
 
-        def __match(h):
-            return self._match(h, self.servername, user, channel, text)
-
-        for h in filter(__match, self.handlers["privmsg"]):
+        matched = self._match("privmsg", user, channel, text)
+        for h in self._admit(matched, user, channel):
             self._dispatch(h, user, channel, text)
 
     def privmsg(self, user, channel, msg):
-        d = threads.deferToThread(self._privmsg, user, channel, msg)
+        d = defer.maybeDeferred(self._privmsg, user, channel, msg)
         d.addErrback(self._complain)
 
     def _userJoined(self, user, channel):
-
-        def __match(h):
-            return self._match(h, self.servername, user, channel, "")
-
-        self._users[channel][user] = dict()
-        log.msg("users = %s" % self._users, level=DEBUG)
-        for h in filter(__match, self.handlers["user_joined"]):
+        self._users.add(channel, user)
+        logger.debug("%s joined %s", user, channel)
+        matched = self._match("user_joined", user, channel, "")
+        for h in self._admit(matched, user, channel):
             self._dispatch(h, user, channel)
 
     def userJoined(self, user, channel):
-        d = threads.deferToThread(self._userJoined, user, channel)
+        d = defer.maybeDeferred(self._userJoined, user, channel)
         d.addErrback(self._complain)
 
     def userLeft(self, user, channel):
-        del self._users[channel][user]
-        log.msg("users = %s" % self._users, level=DEBUG)
+        self._users.remove(channel, user)
+        logger.debug("%s left %s", user, channel)
 
-    def _joined(self, channel):
-        servername = self.servername
+    def userKicked(self, kickee, channel, kicker, message):
+        self.userLeft(kickee, channel)
 
-        def __match(h):
-            if "match_server" in h and not h["match_server"].match(servername):
-                return False
+    def userQuit(self, user, quitMessage):
+        channels = self._users.quit(user)
+        logger.debug("%s quit %s", user, ", ".join(channels))
 
-            if "match_channel" in h and not h["match_channel"].match(channel):
-                return False
+    def left(self, channel):
+        self._users.clear(channel)
+        self._context.forget(channel)
 
-            return True
+    def kickedFrom(self, channel, kicker, message):
+        self._users.clear(channel)
+        self._context.forget(channel)
 
-        for h in filter(__match, self.handlers["joined"]):
+    def _joined(self, channel):
+        for h in self.dispatch["joined"].candidates(self.servername, channel):
             self._dispatch(h, self.nickname, channel)
 
     def joined(self, channel):
-        d = threads.deferToThread(self._joined, channel)
+        self._pending_joins.discard(channel.lower())
+        if not self._pending_joins:
+            self.factory.state = JOINED
+        d = defer.maybeDeferred(self._joined, channel)
         d.addErrback(self._complain)
 
     def userRenamed(self, oldname, newname):
-        log.msg("rename %s -> %s" % (oldname, newname), level=DEBUG)
-        for channel in self._users:
-            self._users[channel][newname] = self._users[channel][oldname]
-            del self._users[channel][oldname]
-            log.msg("users = %s" % self._users, level=DEBUG)
+        logger.debug("rename %s -> %s", oldname, newname)
+        self._users.rename(oldname, newname)
+
+    def irc_JOIN(self, prefix, params):
+        # our own user@host tells how long relayed lines get
+        nick, _, userhost = prefix.partition("!")
+        if nick == self.nickname and userhost:
+            self._userhost = userhost
+        irc.IRCClient.irc_JOIN(self, prefix, params)
 
     def irc_RPL_NAMREPLY(self, prefix, params):
-        channel = params[2].lower()
-        nicklist = filter(lambda x: x, params[3].split(' '))
-        # remove op character
-        nicklist = map(lambda x: x.lstrip("@"), nicklist)
-        self._users[channel] = dict(map(lambda x: (x, dict()), nicklist))
+        # replies of large channels span several lines
+        self._users.names(params[2], params[3].split(" "))
 
     def irc_RPL_ENDOFNAMES(self, prefix, params):
-        log.msg("users = %s" % self._users, level=DEBUG)
+        self._users.end_names(params[1])
+        logger.debug("%d users in %s", len(self._users.members(params[1])),
+                     params[1])
 
 
 class IRCClientFactory(protocol.ClientFactory):
 
     def buildProtocol(self, addr):
         self.protocol = IRCClient(self, self.servername)
-        self.reconnect_delay = 1
         return self.protocol
 
-    def __init__(self, servername, siblings):
+    def __init__(self, servername, siblings, webclient, workers):
         from sabo.setting import setting
         self.servername = servername
         self.siblings = siblings
+        self.webclient = webclient
+        self.workers = workers
         server = setting["servers"][self.servername]
         self.host = server["host"]
         self.port = server["port"]
+        self.min_reconnect_delay = server.get("reconnect_delay", 1)
+        self.max_reconnect_delay = server.get("max_reconnect_delay", 300)
+        self.max_held = server.get("max_queue", 1000)
+        self.reconnect_delay = self.min_reconnect_delay
         self.protocol = None
+        self.link = None
+        self.state = None
+        self.held = deque()
+        self._reconnect_call = None
+
+        # messages a previous run did not get to send
+        self.journal = None
+        if setting.get("journal", None):
+            config = setting["journal"]
+            self.journal = Journal(
+                os.path.join(config["path"], "%s.journal" % servername),
+                config.get("sync", True),
+                config.get("compact_bytes", 4 << 20))
+            self.held.extend(map(fix_message_encoding,
+                                 self.journal.replayed))
+
+    ##########################################################################
+    # Messages held while the server is not registered
+    ##########################################################################
+
+    def hold(self, data):
+        if len(self.held) >= self.max_held:
+            log.msg("held queue of %s is full, message dropped" %
+                    self.servername, level=WARN)
+            self.journal_done(data)
+            return False
+        self.journal_append(data)
+        self.held.append(data)
+        return True
+
+    def release(self):
+        held, self.held = list(self.held), deque()
+        return held
+
+    def enqueue(self, messages):
+        """queue messages, holding them while there is no connection.
+        With a journal, return a Deferred firing once they are on disk"""
+        if self.protocol is not None:
+            self.protocol.mq_extend(messages)
+            self.protocol.schedule()
+        else:
+            for message in messages:
+                self.hold(message)
+        if self.journal is not None:
+            return self.journal.committed()
+
+    ##########################################################################
+    # Journal
+    ##########################################################################
+
+    def journal_append(self, data):
+        if self.journal is not None and "journal" not in data:
+            self.journal.append(data)
+
+    def journal_done(self, data):
+        if self.journal is not None and "journal" in data:
+            self.journal.done(data["journal"])
+
+    def mq_retry_after(self, count=1, size=0, priority=0):
+        if self.protocol is not None:
+            return self.protocol.mq_retry_after(count, size, priority)
+        if len(self.held) + count <= self.max_held:
+            return 0
+        # retry once we are expected to be back
+        remaining = self.reconnect_delay
+        if self._reconnect_call is not None and self._reconnect_call.active():
+            remaining = self._reconnect_call.getTime() - reactor.seconds()
+        return int(math.ceil(remaining)) + 1
+
+    def reconfigure(self, setting, changes):
+        if self.protocol is not None:
+            self.protocol.reconfigure(setting, changes)
+
+    def status(self):
+        """connection and queue state, also what shards report"""
+        status = dict(connected=int(self.state in (REGISTERED, JOINED)),
+                      held=len(self.held))
+        protocol = self.protocol
+        if protocol is None:
+            status.update(free=self.max_held - len(self.held),
+                          free_bytes=None, lowest=None, rate=None,
+                          retry_after=self.mq_retry_after())
+        else:
+            mq = protocol._mq
+            status.update(mq_depth=len(mq), mq_bytes=mq.bytes,
+                          rq_depth=len(protocol._rq),
+                          free=protocol.max_queue - len(mq),
+                          free_bytes=protocol.max_queue_bytes - mq.bytes,
+                          lowest=mq.lowest(), rate=protocol.mq_rate())
+        return status
+
+    ##########################################################################
+    # Connection state
+    ##########################################################################
+
+    def registered(self):
+        self.state = REGISTERED
+        self.reconnect_delay = self.min_reconnect_delay
 
     def reconnect(self, connector, reason):
-        self.reconnect_delay = self.reconnect_delay * 2
-        time.sleep(self.reconnect_delay)
-        connector.connect()
+        """reconnect after a capped, jittered exponential backoff"""
+        self.state = BACKING_OFF
+        delay = random.uniform(self.reconnect_delay / 2.0,
+                               self.reconnect_delay)
+        self.reconnect_delay = min(self.reconnect_delay * 2,
+                                   self.max_reconnect_delay)
+        log.msg("reconnecting to %s in %.1fs" % (self.servername, delay),
+                level=WARN)
+        self._reconnect_call = reactor.callLater(delay, connector.connect)
+
+    def _lost(self):
+        # keep what the lost connection did not send
+        if self.protocol is not None:
+            for message in self.protocol._mq:
+                self.hold(message)
+            self.protocol = None
 
     def startedConnecting(self, connector):
         log.msg("connecting to %s" % connector, level=DEBUG)
+        self.state = CONNECTING
 
     def clientConnectionLost(self, connector, reason):
         """If we lost server, reconnect to it"""
         log.msg("connection lost. start reconnecting", level=WARN)
+        metrics.inc("sabo_reconnects_total", (("server", self.servername),))
+        self._lost()
         self.reconnect(connector, reason)
 
-    def clientConnectFailed(self, connector, reason):
-        log.msg("connection failed:" + reason, level=WARN)
+    def clientConnectionFailed(self, connector, reason):
+        log.msg("connection failed: %s" % reason.getErrorMessage(),
+                level=WARN)
+        metrics.inc("sabo_reconnects_total", (("server", self.servername),))
+        self._lost()
         self.reconnect(connector, reason)
 
 # vim: ts=4 sw=4 ai et
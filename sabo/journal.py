@@ -0,0 +1,210 @@
+# -*- mode: python -*-
+
+"""
+Append-only journal of outbound messages of one server.
+
+  journal:
+    path: /var/lib/sabo        # one <server>.journal file per server
+    sync: true                 # fsync commits, or leave it to the OS
+    compact_bytes: 4194304     # compact once the file is this large
+
+Each accepted message is written as {"a": id, "m": message} and, once
+sent or evicted, followed by {"d": [ids]}. Records are buffered and
+written by a single writer thread. Everything appended while a commit is
+in flight goes into the next one, so that one fsync covers many
+messages. On start the messages without a done record are replayed.
+When the file grew large and is mostly done records, the live ones are
+rewritten to a new file which replaces the old one.
+
+"""
+
+from twisted.internet import reactor, defer, threads
+from twisted.python.threadpool import ThreadPool
+from twisted.python.failure import Failure
+from twisted.python import log
+from ujson import encode as json_encode, decode as json_decode
+from collections import OrderedDict
+from logging import WARN
+
+import os
+
+__all__ = ["Journal"]
+
+
+class Journal(object):
+
+    def __init__(self, path, sync=True, compact_bytes=4 << 20):
+        self.path = path
+        self.sync = sync
+        self.compact_bytes = compact_bytes
+        self.live = OrderedDict()
+        self.size = 0
+        self._next_id = 1
+        self._buffer = list()
+        self._waiting = list()
+        self._inflight = list()
+        self._flushing = False
+        self._flush_call = None
+
+        self.replayed = self._load()
+        self._file = open(self.path, "ab")
+
+        self._pool = ThreadPool(1, 1, name="sabo-journal")
+        self._pool.start()
+        reactor.addSystemEventTrigger("during", "shutdown", self.close)
+
+    ##########################################################################
+    # Replay
+    ##########################################################################
+
+    def _load(self):
+        """read the journal, return messages not yet done"""
+        if not os.path.exists(self.path):
+            return list()
+
+        messages = OrderedDict()
+        with open(self.path, "rb") as f:
+            for line in f:
+                self.size += len(line)
+                try:
+                    record = json_decode(line)
+                except ValueError:
+                    # torn write of the last commit
+                    log.msg("%s: skipping malformed record" % self.path,
+                            level=WARN)
+                    continue
+                if "a" in record:
+                    messages[record["a"]] = (record["m"], line)
+                    self._next_id = max(self._next_id, record["a"] + 1)
+                else:
+                    for x in record["d"]:
+                        messages.pop(x, None)
+
+        for x, (message, line) in messages.items():
+            self.live[x] = line
+        log.msg("%s: %d messages to replay" % (self.path, len(messages)))
+        return [message for message, line in messages.values()]
+
+    ##########################################################################
+    # Group commit
+    ##########################################################################
+
+    def _write(self, data, sync):
+        self._file.write(data)
+        self._file.flush()
+        if sync:
+            os.fsync(self._file.fileno())
+
+    def _schedule(self):
+        if not self._flushing and self._flush_call is None:
+            self._flush_call = reactor.callLater(0, self._flush)
+
+    def _flush(self):
+        self._flush_call = None
+        if self._flushing or not self._buffer:
+            return
+        data, self._buffer = "".join(self._buffer), list()
+        self._inflight, self._waiting = self._waiting, list()
+        self._flushing = True
+        self.size += len(data)
+
+        def __done(value):
+            self._flushing = False
+            self._release(value)
+            if self._buffer:
+                self._schedule()
+            elif self._compactable():
+                self._compact()
+
+        d = threads.deferToThreadPool(reactor, self._pool, self._write,
+                                      data, self.sync)
+        d.addBoth(__done)
+
+    def append(self, message):
+        """journal a message, tagging it with its id"""
+        message["journal"] = [self._next_id]
+        line = json_encode(dict(a=self._next_id, m=message)) + "\n"
+        self.live[self._next_id] = line
+        self._next_id += 1
+        self._buffer.append(line)
+        self._schedule()
+
+    def done(self, ids):
+        """the messages with these ids were sent or dropped"""
+        ids = [x for x in ids if self.live.pop(x, None) is not None]
+        if ids:
+            self._buffer.append(json_encode(dict(d=ids)) + "\n")
+            self._schedule()
+
+    def _release(self, value):
+        inflight, self._inflight = self._inflight, list()
+        if isinstance(value, Failure):
+            log.err(value, "%s: write failed" % self.path)
+            for d in inflight:
+                d.errback(value)
+        else:
+            for d in inflight:
+                d.callback(None)
+
+    def committed(self):
+        """a Deferred firing once everything appended so far is on disk"""
+        if not self._buffer and not self._flushing:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        if self._buffer:
+            self._waiting.append(d)
+        else:
+            # everything is in the commit in flight
+            self._inflight.append(d)
+        return d
+
+    ##########################################################################
+    # Compaction
+    ##########################################################################
+
+    def _compactable(self):
+        if self.size < self.compact_bytes:
+            return False
+        live = sum(map(len, self.live.itervalues()))
+        return live * 2 < self.size
+
+    def _rewrite(self, data, sync):
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            if sync:
+                os.fsync(f.fileno())
+        os.rename(tmp, self.path)
+        self._file.close()
+        self._file = open(self.path, "ab")
+
+    def _compact(self):
+        data = "".join(self.live.itervalues())
+        log.msg("%s: compacting %d bytes into %d" %
+                (self.path, self.size, len(data)))
+        self._flushing = True
+
+        def __done(value):
+            if not isinstance(value, Failure):
+                self.size = len(data)
+            self._flushing = False
+            self._release(value)
+            if self._buffer:
+                self._schedule()
+
+        # the writer thread runs it between two commits
+        d = threads.deferToThreadPool(reactor, self._pool, self._rewrite,
+                                      data, self.sync)
+        d.addBoth(__done)
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._pool.stop()
+        if self._buffer:
+            self._write("".join(self._buffer), self.sync)
+            self._buffer = list()
+        self._file.close()
+
+# vim: ts=4 sw=4 ai et
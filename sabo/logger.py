@@ -0,0 +1,147 @@
+# -*- mode: python -*-
+
+"""
+Level-gated, buffered logging.
+
+debug(), info() and warn() take a format string and its arguments and
+only format them when the level is enabled, so that disabled messages
+cost a comparison. Raw IRC traffic goes through traffic(), which logs
+every line at DEBUG and a sample of the lines otherwise:
+
+  logging:
+    level: info         # debug, info, warn
+    traffic: 0.01       # fraction of raw lines logged above DEBUG
+    buffer: 65536       # bytes buffered before writing
+    flush_interval: 1   # seconds between flushes
+
+BufferedLogObserver replaces twisted's FileLogObserver, which writes and
+flushes once per message, by a buffer written out in batches. Errors are
+written immediately.
+
+"""
+
+from twisted.internet import reactor, task
+from twisted.python import log
+from logging import DEBUG, INFO, WARN
+from threading import Lock
+
+import random
+
+__all__ = ["debug", "info", "warn", "enabled", "traffic", "configure",
+           "start", "BufferedLogObserver"]
+
+LEVELS = dict(debug=DEBUG, info=INFO, warn=WARN, warning=WARN)
+
+_level = INFO
+_traffic = 0.0
+_observer = None
+
+
+def enabled(level):
+    return level >= _level
+
+
+def debug(fmt, *args):
+    if _level <= DEBUG:
+        log.msg(fmt % args if args else fmt, level=DEBUG)
+
+
+def info(fmt, *args):
+    if _level <= INFO:
+        log.msg(fmt % args if args else fmt, level=INFO)
+
+
+def warn(fmt, *args):
+    if _level <= WARN:
+        log.msg(fmt % args if args else fmt, level=WARN)
+
+
+def traffic(direction, line):
+    """log a raw line, sampled unless DEBUG is enabled"""
+    if _level <= DEBUG:
+        log.msg("%s %s" % (direction, line), level=DEBUG)
+    elif _traffic and random.random() < _traffic:
+        log.msg("%s %s" % (direction, line), level=_level)
+
+
+class BufferedLogObserver(log.FileLogObserver):
+
+    def __init__(self, f, size=65536, interval=1.0):
+        log.FileLogObserver.__init__(self, f)
+        self.size = size
+        self._buffer = list()
+        self._bytes = 0
+        self._lock = Lock()
+        self._second = None
+        self._stamp = None
+        self._flusher = task.LoopingCall(self.drain)
+        self._flusher.start(interval, now=False)
+        reactor.addSystemEventTrigger("after", "shutdown", self.stop)
+
+    def formatTime(self, when):
+        # one strftime per second instead of one per message
+        second = int(when)
+        if second != self._second:
+            self._second = second
+            self._stamp = log.FileLogObserver.formatTime(self, second)
+        return self._stamp
+
+    def emit(self, eventDict):
+        error = eventDict["isError"]
+        if not error and eventDict.get("level", INFO) < _level:
+            return
+        text = log.textFromEventDict(eventDict)
+        if text is None:
+            return
+        if isinstance(text, unicode):
+            text = text.encode("utf-8", "replace")
+        line = "%s [%s] %s\n" % (self.formatTime(eventDict["time"]),
+                                 eventDict["system"],
+                                 text.replace("\n", "\n\t"))
+        with self._lock:
+            self._buffer.append(line)
+            self._bytes += len(line)
+            full = self._bytes >= self.size
+        if full or error:
+            self.drain()
+
+    def drain(self):
+        with self._lock:
+            if not self._buffer:
+                return
+            data, self._buffer, self._bytes = "".join(self._buffer), [], 0
+        self.write(data)
+        self.flush()
+
+    def stop(self):
+        """write out what is left, unbuffered from now on"""
+        if self._flusher.running:
+            self._flusher.stop()
+        self.size = 0
+        self.drain()
+
+
+def start(f):
+    """log to file object f through a buffered observer"""
+    global _observer
+    _observer = BufferedLogObserver(f)
+    log.startLoggingWithObserver(_observer.emit)
+    return _observer
+
+
+def configure(config=None):
+    global _level, _traffic
+    config = config or dict()
+    level = str(config.get("level", "info")).lower()
+    if level not in LEVELS:
+        raise ValueError("invalid log level: %s" % level)
+    _level = LEVELS[level]
+    _traffic = float(config.get("traffic", 0.0))
+    if _observer is not None:
+        _observer.size = config.get("buffer", _observer.size)
+        interval = config.get("flush_interval", None)
+        if interval is not None and interval != _observer._flusher.interval:
+            _observer._flusher.stop()
+            _observer._flusher.start(interval, now=False)
+
+# vim: ts=4 sw=4 ai et
@@ -0,0 +1,130 @@
+# -*- mode: python -*-
+
+"""
+Process-wide counters and histograms rendered in the Prometheus text
+exposition format.
+
+Recording is a dict update (and a bisect for histograms), cheap enough to
+stay enabled on every line.
+
+"""
+
+from bisect import bisect_left
+
+__all__ = ["metrics", "Registry", "Histogram"]
+
+# upper bounds of histogram buckets in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+           0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+class Histogram(object):
+
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n") \
+        .replace('"', '\\"')
+
+
+def _labels(labels):
+    # labels come back from JSON as lists of unicode strings
+    return tuple((str(k), v.encode("UTF-8") if isinstance(v, unicode) else v)
+                 for k, v in labels)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, _escape(v)) for k, v in labels)
+
+
+def format_sample(name, labels, value):
+    if isinstance(value, float):
+        value = repr(value)
+    return "%s%s %s" % (name, format_labels(labels), value)
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.counters = dict()
+        self.histograms = dict()
+
+    def inc(self, name, labels=(), n=1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + n
+
+    def observe(self, name, labels, value):
+        key = (name, labels)
+        if key not in self.histograms:
+            self.histograms[key] = Histogram()
+        self.histograms[key].observe(value)
+
+    def snapshot(self):
+        """counters and histograms as plain lists, e.g. to send elsewhere"""
+        return dict(
+            counters=[(name, labels, value) for (name, labels), value
+                      in self.counters.items()],
+            histograms=[(name, labels, h.counts, h.sum, h.count)
+                        for (name, labels), h in self.histograms.items()])
+
+    def merge(self, snapshot):
+        """add the counters and histograms of a snapshot"""
+        for name, labels, value in snapshot["counters"]:
+            self.inc(str(name), _labels(labels), value)
+        for name, labels, counts, total, count in snapshot["histograms"]:
+            key = (str(name), _labels(labels))
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            h = self.histograms[key]
+            h.counts = [x + y for x, y in zip(h.counts, counts)]
+            h.sum += total
+            h.count += count
+
+    def render(self, gauges=()):
+        """gauges are (name, labels, value) sampled by the caller"""
+        lines = list()
+
+        seen = set()
+        for name, labels, value in sorted(gauges, key=lambda x: x[0]):
+            if name not in seen:
+                lines.append("# TYPE %s gauge" % name)
+                seen.add(name)
+            lines.append(format_sample(name, labels, value))
+
+        for (name, labels), value in sorted(self.counters.items()):
+            if name not in seen:
+                lines.append("# TYPE %s counter" % name)
+                seen.add(name)
+            lines.append(format_sample(name, labels, value))
+
+        for (name, labels), h in sorted(self.histograms.items()):
+            if name not in seen:
+                lines.append("# TYPE %s histogram" % name)
+                seen.add(name)
+            total = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), h.counts):
+                total += count
+                lines.append(format_sample(name + "_bucket",
+                                           labels + (("le", bound),), total))
+            lines.append(format_sample(name + "_sum", labels, h.sum))
+            lines.append(format_sample(name + "_count", labels, h.count))
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = Registry()
+
+# vim: ts=4 sw=4 ai et
@@ -0,0 +1,51 @@
+# -*- mode: python -*-
+
+"""
+In-process versions of the services in service/, for `python:' handlers.
+
+A plugin is called as f(message, context) on the reactor thread (or in
+the worker pool for `blocking' handlers). message holds servername, user,
+channel and text, context the fields the handler asks for (see
+sabo.context), to be treated as read-only. It returns what a webhook
+would: a dict with text and optionally users, channels or servername, a
+string, None, or a Deferred firing with one of these.
+
+"""
+
+from sabo.timezone import zone
+
+import time
+
+__all__ = ["clock", "names", "rename"]
+
+TIMEZONES = ["Asia/Shanghai", "America/New_York", "America/Chicago"]
+
+
+def clock(message, context):
+    """time.rpy"""
+    output = list()
+    now = time.time()
+    # read from the zone files, the process timezone is left alone
+    for tz in TIMEZONES:
+        offset, name = zone(tz).at(now)
+        output.append("%s %s (%s)" % (
+            time.strftime("%X %Y-%m-%d", time.gmtime(now + offset)),
+            name, tz))
+    return dict(text=[" || ".join(output)])
+
+
+def names(message, context):
+    """names.rpy, needs `users' in the context"""
+    users = context["users"].get("&bitlbee", dict()).keys()
+    users = ",".join(filter(lambda x: x != "root", users))
+    return dict(text=["online: %s" % users])
+
+
+def rename(message, context):
+    """rename.rpy"""
+    return dict(servername=message["servername"],
+                channels=["&bitlbee"],
+                text=["rename %s %s" % (message["user"],
+                                        message["text"][6:])])
+
+# vim: ts=4 sw=4 ai et
@@ -0,0 +1,150 @@
+# -*- mode: python -*-
+
+"""
+On-demand profiling of the running process.
+
+A window is opened for the reactor thread, the worker pool or both and
+closes by itself after at most MAX_SECONDS. The reactor thread is
+profiled with cProfile from start to stop. Each call run by the worker
+pool gets a profiler of its own in its thread, whose stats are merged on
+the reactor thread. While no window is open nothing is hooked, the pool
+only checks one attribute per call.
+
+Stats of the last window are kept per thread group, summarized for the
+functions of the message path, or dumped as pstats.Stats.dump_stats
+does, to be read back with pstats.Stats(path).
+
+"""
+
+from twisted.internet import reactor
+from twisted.python import log
+from functools import partial
+
+import os
+import time
+import pstats
+import marshal
+import cProfile
+
+__all__ = ["Profiler", "ProfilerBusy", "THREADS", "WATCHED"]
+
+THREADS = ("reactor", "workers")
+# functions of IRCClient summarized
+WATCHED = ("_privmsg", "_match", "_dispatch", "_send_text", "schedule")
+MAX_SECONDS = 300
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+def _stats(profile):
+    try:
+        return pstats.Stats(profile)
+    except TypeError:
+        # nothing was called
+        return None
+
+
+class Profiler(object):
+
+    def __init__(self, workers=None):
+        self.workers = workers
+        self.threads = ()
+        self.started = None
+        self.seconds = 0
+        self.stats = dict()
+        self._profile = None
+        self._stop_call = None
+
+    def running(self):
+        return self._stop_call is not None
+
+    def start(self, threads=("reactor",), seconds=30):
+        """open a window of at most MAX_SECONDS"""
+        if self.running():
+            raise ProfilerBusy("profiling %s since %s" %
+                               (",".join(self.threads),
+                                time.ctime(self.started)))
+        threads = tuple(x for x in THREADS if x in threads)
+        if not threads:
+            raise ValueError("threads must be some of %s" % ", ".join(THREADS))
+        if "workers" in threads and self.workers is None:
+            raise ValueError("no worker pool in this process")
+        if seconds <= 0:
+            raise ValueError("seconds must be positive")
+
+        self.threads = threads
+        self.started = time.time()
+        self.seconds = min(seconds, MAX_SECONDS)
+        self.stats = dict()
+        if "workers" in threads:
+            self.workers.profile = partial(self._pooled, self.started)
+        if "reactor" in threads:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        self._stop_call = reactor.callLater(self.seconds, self.stop)
+        log.msg("profiling %s for %.1fs" % (",".join(threads), self.seconds))
+
+    def stop(self):
+        """close the window, False if none was open"""
+        if not self.running():
+            return False
+        if self._stop_call.active():
+            self._stop_call.cancel()
+        self._stop_call = None
+        if self._profile is not None:
+            self._profile.disable()
+            self._add(self.started, "reactor", _stats(self._profile))
+            self._profile = None
+        if "workers" in self.threads:
+            self.workers.profile = None
+        self.seconds = time.time() - self.started
+        log.msg("profiled %s for %.1fs" % (",".join(self.threads),
+                                           self.seconds))
+        return True
+
+    def _pooled(self, window, f, *args, **kwargs):
+        """run f under a profiler of its own, in a worker thread"""
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(f, *args, **kwargs)
+        finally:
+            reactor.callFromThread(self._add, window, "workers",
+                                   _stats(profile))
+
+    def _add(self, window, thread, stats):
+        # calls still running when their window closed are dropped
+        if stats is None or window != self.started:
+            return
+        if thread in self.stats:
+            self.stats[thread].add(stats)
+        else:
+            self.stats[thread] = stats
+
+    def summary(self):
+        """the watched functions of the current or last window"""
+        seconds = time.time() - self.started if self.running() \
+            else self.seconds
+        result = dict(running=self.running(), threads=list(self.threads),
+                      started=self.started, seconds=seconds, stats=dict())
+        for thread, stats in self.stats.items():
+            functions = dict()
+            for (filename, line, name), (cc, nc, tt, ct, callers) in \
+                    stats.stats.iteritems():
+                if name not in WATCHED or \
+                   os.path.basename(filename) != "ircclient.py":
+                    continue
+                functions[name] = dict(calls=nc, tottime=tt, cumtime=ct,
+                                       percall_ms=ct * 1000.0 / nc)
+            result["stats"][thread] = dict(calls=stats.total_calls,
+                                           seconds=stats.total_tt,
+                                           functions=functions,
+                                           dump="%s.pstats" % thread)
+        return result
+
+    def dump(self, thread):
+        """stats of a thread group in the format of pstats dump files"""
+        return marshal.dumps(self.stats[thread].stats)
+
+# vim: ts=4 sw=4 ai et
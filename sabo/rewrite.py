@@ -0,0 +1,106 @@
+# -*- mode: python -*-
+
+"""
+Rewrite pipelines of redirect handlers.
+
+Rules run in order, each one rewriting the output of the previous one.
+`text` rules substitute in process. `http` rules post every distinct
+fragment matched by `match_text` to the service concurrently and splice
+the results back in. Rules without `match_text` are skipped. Results
+are memoized per service URL and shared by all handlers, so a link
+relayed to several channels is looked up once.
+
+"""
+
+from twisted.internet import defer
+from twisted.python import log
+from sabo.cache import ResponseCache
+from logging import WARN
+
+__all__ = ["RewritePipeline"]
+
+# memoized results per service url, kept across reloads
+_caches = dict()
+
+
+class TextRewrite(object):
+
+    def __init__(self, rule):
+        self.regex = rule["match_text"]
+        self.replace = rule["text"]
+
+    def __call__(self, text, post):
+        return self.regex.sub(self.replace, text)
+
+
+class HttpRewrite(object):
+
+    def __init__(self, rule):
+        self.rule = rule
+        self.regex = rule["match_text"]
+        self.concurrency = rule.get("concurrency", 4)
+        if rule["http"] not in _caches:
+            config = rule.get("cache", dict(ttl=3600, size=1024))
+            _caches[rule["http"]] = ResponseCache.from_config(config)
+        self.cache = _caches[rule["http"]]
+
+    def _post(self, fragment, post):
+        d = post(self.rule, fragment.encode("UTF-8"))
+        d.addCallback(lambda x: x.decode("UTF-8", "ignore"))
+        return d
+
+    def _lookup(self, fragment, post, semaphore):
+
+        def __failed(err):
+            log.msg("rewrite `%s' failed: %s" % (fragment, err.value),
+                    level=WARN)
+            return fragment
+
+        d = semaphore.run(self.cache.get, (fragment,),
+                          self._post, fragment, post)
+        d.addErrback(__failed)
+        return d
+
+    def __call__(self, text, post):
+        fragments = set(m.group(0) for m in self.regex.finditer(text))
+        if not fragments:
+            return text
+
+        fragments = list(fragments)
+        semaphore = defer.DeferredSemaphore(self.concurrency)
+        d = defer.gatherResults([self._lookup(x, post, semaphore)
+                                 for x in fragments])
+
+        def __splice(results):
+            results = dict(zip(fragments, results))
+            return self.regex.sub(lambda m: results[m.group(0)], text)
+
+        d.addCallback(__splice)
+        return d
+
+
+class RewritePipeline(object):
+
+    def __init__(self, rules):
+        self.steps = list()
+        for rule in rules:
+            if "match_text" not in rule:
+                continue
+            if "http" in rule:
+                self.steps.append(HttpRewrite(rule))
+            elif "text" in rule:
+                self.steps.append(TextRewrite(rule))
+            else:
+                log.msg("invalid rewrite rule: %s" % str(rule))
+
+    def __len__(self):
+        return len(self.steps)
+
+    def run(self, text, post):
+        """post(rule, body) must return a Deferred of the response body"""
+        d = defer.succeed(text)
+        for step in self.steps:
+            d.addCallback(step, post)
+        return d
+
+# vim: ts=4 sw=4 ai et
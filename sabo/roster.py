@@ -0,0 +1,129 @@
+# -*- mode: python -*-
+
+"""
+Channel membership of one connection.
+
+Nicks are interned and kept in one set per channel, with a reverse
+nick -> channels index so that renames and quits only touch the channels
+the nick is actually in. Channel names are case-insensitive.
+
+Every change bumps `version' and the version of the channels it touched,
+so that snapshots built from the roster know when they are stale.
+
+"""
+
+__all__ = ["Roster"]
+
+# channel membership prefixes in NAMES replies
+MODE_PREFIXES = "@+%&~"
+
+
+def _intern(nick):
+    return intern(nick) if isinstance(nick, str) else nick
+
+
+class Roster(object):
+
+    def __init__(self):
+        self._channels = dict()
+        self._nicks = dict()
+        self._names = dict()
+        self._versions = dict()
+        self.version = 0
+
+    def __repr__(self):
+        return repr(dict((k, sorted(v)) for k, v in self._channels.items()))
+
+    def __contains__(self, channel):
+        return channel.lower() in self._channels
+
+    def channels(self):
+        return self._channels.keys()
+
+    def members(self, channel):
+        return self._channels.get(channel.lower(), frozenset())
+
+    def channels_of(self, nick):
+        return self._nicks.get(nick, frozenset())
+
+    def channel_version(self, channel):
+        return self._versions.get(channel.lower(), 0)
+
+    def _touch(self, channels):
+        self.version += 1
+        for channel in channels:
+            self._versions[channel] = self.version
+
+    def add(self, channel, nick):
+        channel, nick = channel.lower(), _intern(nick)
+        self._channels.setdefault(channel, set()).add(nick)
+        self._nicks.setdefault(nick, set()).add(channel)
+        self._touch((channel,))
+
+    def _unlink(self, nick, channel):
+        channels = self._nicks.get(nick)
+        if channels is not None:
+            channels.discard(channel)
+            if not channels:
+                del self._nicks[nick]
+
+    def remove(self, channel, nick):
+        channel = channel.lower()
+        members = self._channels.get(channel)
+        if members is not None:
+            members.discard(nick)
+        self._unlink(nick, channel)
+        self._touch((channel,))
+
+    def rename(self, oldname, newname):
+        channels = self._nicks.pop(oldname, None)
+        if not channels:
+            return
+        newname = _intern(newname)
+        for channel in channels:
+            members = self._channels[channel]
+            members.discard(oldname)
+            members.add(newname)
+        self._nicks.setdefault(newname, set()).update(channels)
+        self._touch(channels)
+
+    def quit(self, nick):
+        """remove nick from all channels, return the channels it was in"""
+        channels = self._nicks.pop(nick, set())
+        for channel in channels:
+            self._channels[channel].discard(nick)
+        if channels:
+            self._touch(channels)
+        return channels
+
+    def clear(self, channel):
+        """forget a channel we are no longer in"""
+        channel = channel.lower()
+        for nick in self._channels.pop(channel, ()):
+            self._unlink(nick, channel)
+        self._touch((channel,))
+
+    def names(self, channel, nicks):
+        """accumulate one RPL_NAMREPLY line"""
+        pending = self._names.setdefault(channel.lower(), set())
+        for nick in nicks:
+            nick = nick.lstrip(MODE_PREFIXES)
+            if nick:
+                pending.add(_intern(nick))
+
+    def end_names(self, channel):
+        """RPL_ENDOFNAMES: replace the membership with the accumulated one"""
+        channel = channel.lower()
+        pending = self._names.pop(channel, set())
+        self.clear(channel)
+        self._channels[channel] = pending
+        for nick in pending:
+            self._nicks.setdefault(nick, set()).add(channel)
+        self._touch((channel,))
+
+    def as_dict(self):
+        """the legacy {channel: {nick: {}}} layout used by webhooks"""
+        return dict((channel, dict.fromkeys(members, dict()))
+                    for channel, members in self._channels.items())
+
+# vim: ts=4 sw=4 ai et
@@ -0,0 +1,229 @@
+# -*- mode: python -*-
+
+"""
+Outbound scheduling primitives.
+
+OutboundQueue keeps one FIFO per target and serves targets round robin so
+a busy relay cannot starve quiet channels. TokenBucket enforces the line
+budget of a server connection. RateLimiter keeps token buckets by key to
+limit how often users and handlers may trigger work.
+
+"""
+
+from collections import deque, OrderedDict
+
+import time
+
+__all__ = ["TokenBucket", "RateLimiter", "RateMeter", "OutboundQueue"]
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate=None, burst=1):
+        """rate is in tokens per second, None means unlimited"""
+        self.tokens = max(burst, 1)
+        self.update(rate, burst)
+
+    def update(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = min(self.tokens, self.burst)
+        self.stamp = time.time()
+
+    def _refill(self):
+        now = time.time()
+        if self.rate:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def consume(self, n=1):
+        """take n tokens, the bucket may go into debt"""
+        if self.rate is None:
+            return
+        self._refill()
+        self.tokens -= n
+
+    def delay(self):
+        """seconds to wait until one token is available"""
+        if self.rate is None:
+            return 0
+        self._refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter(object):
+    """token buckets by key, rate in triggers per second
+
+    A bucket left alone for burst / rate seconds is full again, the same
+    as a new one, so such buckets are forgotten. Buckets are kept in the
+    order of their last use, which makes expiry O(1) per call.
+    """
+
+    SCOPES = ("user", "channel", "handler")
+
+    def __init__(self, rate, burst=1, per="user", size=65536):
+        if per not in self.SCOPES:
+            raise ValueError("invalid rate limit scope: %s" % per)
+        self.rate = float(rate)
+        self.burst = max(burst, 1)
+        self.per = per
+        self.size = size
+        self.idle = self.burst / self.rate
+        self._buckets = OrderedDict()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(**config)
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def key(self, servername, user, channel):
+        if self.per == "user":
+            return (servername, user)
+        if self.per == "channel":
+            return (servername, channel)
+        return None
+
+    def _expire(self, now):
+        buckets = self._buckets
+        while buckets:
+            key, (tokens, stamp) = next(buckets.iteritems())
+            if now - stamp < self.idle and len(buckets) < self.size:
+                break
+            del buckets[key]
+
+    def allow(self, key, now=None):
+        """take a token from the bucket of key, False if there is none"""
+        now = now or time.time()
+        self._expire(now)
+        bucket = self._buckets.pop(key, None)
+        if bucket is None:
+            tokens = self.burst
+        else:
+            tokens = min(self.burst,
+                         bucket[0] + (now - bucket[1]) * self.rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self._buckets[key] = (tokens, now)
+        return allowed
+
+
+class RateMeter(object):
+    """events per second over a sliding window of one second slots"""
+
+    def __init__(self, window=10):
+        self.window = window
+        self._slots = deque()
+
+    def _expire(self, now):
+        while self._slots and self._slots[0][0] <= now - self.window:
+            self._slots.popleft()
+
+    def mark(self, n=1):
+        now = int(time.time())
+        if self._slots and self._slots[-1][0] == now:
+            self._slots[-1][1] += n
+        else:
+            self._slots.append([now, n])
+        self._expire(now)
+
+    def rate(self):
+        self._expire(int(time.time()))
+        return sum(x[1] for x in self._slots) / float(self.window)
+
+
+class OutboundQueue(object):
+    """
+    Items are queued per (priority, key). Higher priorities are always
+    served first, keys of the same priority are served round robin.
+
+    """
+
+    def __init__(self):
+        self._queues = dict()
+        self._rings = dict()
+        self._levels = list()
+        self._size = 0
+        self.bytes = 0
+
+    def __len__(self):
+        return self._size
+
+    def __nonzero__(self):
+        return self._size > 0
+
+    def __iter__(self):
+        for level in self._levels:
+            for qkey in self._rings[level]:
+                for size, item in self._queues[qkey]:
+                    yield item
+
+    def depth(self, key, priority=0):
+        return len(self._queues.get((priority, key), ()))
+
+    def tail(self, key, priority=0):
+        """last item queued for key, or None"""
+        queue = self._queues.get((priority, key))
+        return queue[-1][1] if queue else None
+
+    def grow(self, key, size, priority=0):
+        """account size more bytes to the tail of key"""
+        self._queues[(priority, key)][-1][0] += size
+        self.bytes += size
+
+    def lowest(self):
+        """lowest priority having queued items, or None"""
+        return self._levels[-1] if self._levels else None
+
+    def push(self, key, item, size=0, priority=0):
+        qkey = (priority, key)
+        if qkey not in self._queues:
+            self._queues[qkey] = deque()
+            if priority not in self._rings:
+                self._rings[priority] = deque()
+                self._levels = sorted(self._rings, reverse=True)
+            self._rings[priority].append(qkey)
+        self._queues[qkey].append([size, item])
+        self._size += 1
+        self.bytes += size
+
+    def requeue(self, key, item, size=0, priority=0):
+        """put item back at the head of key, which keeps its turn"""
+        qkey = (priority, key)
+        if qkey in self._queues:
+            self._queues[qkey].appendleft([size, item])
+            self._size += 1
+            self.bytes += size
+        else:
+            self.push(key, item, size, priority)
+
+    def _pop(self, level):
+        ring = self._rings[level]
+        qkey = ring.popleft()
+        queue = self._queues[qkey]
+        size, item = queue.popleft()
+        if queue:
+            ring.append(qkey)
+        else:
+            del self._queues[qkey]
+            if not ring:
+                del self._rings[level]
+                self._levels.remove(level)
+        self._size -= 1
+        self.bytes -= size
+        return item
+
+    def pop(self):
+        """pop the head of the next target in turn"""
+        return self._pop(self._levels[0])
+
+    def evict(self):
+        """drop the next item of the lowest priority"""
+        return self._pop(self._levels[-1])
+
+# vim: ts=4 sw=4 ai et
@@ -9,15 +9,126 @@ All values except 'text' must be UTF-8 string of <type 'str'>
 """
 
 from twisted.web.resource import Resource
+from twisted.web.server import Request, Site
+from twisted.web.http import HTTPChannel
 from twisted.python.failure import Failure
 from twisted.python import log
 from twisted.web.server import NOT_DONE_YET
 from twisted.internet import defer
 from logging import DEBUG
 from ujson import decode as json_decode, encode as json_encode
-from sabo.util import fix_message_encoding
+from sabo.util import fix_message_encoding, message_size
+from sabo.metrics import metrics, Registry
+from sabo.profiler import ProfilerBusy
+from sabo import logger
+from collections import OrderedDict
 
 import time
+import base64
+
+NDJSON = "application/x-ndjson"
+
+
+class Throttled(Exception):
+
+    def __init__(self, message, retry_after):
+        Exception.__init__(self, message)
+        self.retry_after = retry_after
+
+
+class NDJSONParser(object):
+    """parse newline-delimited JSON records chunk by chunk, handing each
+    chunk to sink(records, results, commits) as soon as it is parsed"""
+
+    def __init__(self, sink):
+        self._buffer = ""
+        self.count = 0
+        self.sink = sink
+        self.results = list()
+        self.commits = list()
+
+    def _parse(self, line):
+        self.count += 1
+        try:
+            return (json_decode(line), None)
+        except ValueError as e:
+            return (None, "malformed JSON: %s" % str(e))
+
+    def feed(self, data):
+        lines = (self._buffer + data).split("\n")
+        self._buffer = lines.pop()
+        records = [self._parse(x) for x in lines if x.strip()]
+        if records:
+            self.sink(records, self.results, self.commits)
+
+    def close(self):
+        if self._buffer.strip():
+            self.sink([self._parse(self._buffer)], self.results,
+                      self.commits)
+        self._buffer = ""
+
+
+class IngestRequest(Request):
+    """Request queueing newline-delimited JSON bodies while they arrive.
+
+    POSTs to a path the site takes in are queued chunk by chunk and only
+    the statuses of their records are kept until the body is complete.
+    Any other request is buffered and rendered as usual.
+    """
+
+    ingest = None
+    line = None
+
+    def gotRequestLine(self, command, path):
+        """called by IngestChannel before the headers are parsed"""
+        self.line = (command, path.split("?")[0].rstrip("/"))
+
+    def gotLength(self, length):
+        content_type = self.requestHeaders.getRawHeaders("content-type")
+        if (self.line is not None and self.line[0] == "POST" and
+            content_type and content_type[0].startswith(NDJSON)):
+            # the resource is only looked up once the body is complete
+            service = self.channel.site.ingest.get(self.line[1], None)
+            if service is not None:
+                self.ingest = NDJSONParser(service._sendChunk)
+        Request.gotLength(self, length)
+
+    def handleContentChunk(self, data):
+        if self.ingest is not None:
+            self.ingest.feed(data)
+        else:
+            Request.handleContentChunk(self, data)
+
+    def requestReceived(self, command, path, version):
+        if self.ingest is not None:
+            self.ingest.close()
+        Request.requestReceived(self, command, path, version)
+
+
+class IngestChannel(HTTPChannel):
+    """HTTPChannel telling its requests their method and path before
+    their body arrives"""
+
+    def lineReceived(self, line):
+        last = self.requests[-1] if self.requests else None
+        HTTPChannel.lineReceived(self, line)
+        if self.requests and self.requests[-1] is not last:
+            # a request line, rejected by HTTPChannel unless it has 3 parts
+            parts = line.split()
+            if len(parts) == 3:
+                self.requests[-1].gotRequestLine(parts[0], parts[1])
+
+
+class IngestSite(Site):
+    """Site streaming newline-delimited JSON POSTed to the paths of
+    ingest, a dict of path -> MessageService"""
+
+    protocol = IngestChannel
+    requestFactory = IngestRequest
+
+    def __init__(self, resource, ingest, *args, **kwargs):
+        Site.__init__(self, resource, *args, **kwargs)
+        self.ingest = ingest
 
 
 class BaseService(Resource):
@@ -25,7 +136,7 @@ class BaseService(Resource):
     def prepare(self, request):
         request.content.seek(0, 0)
         content = request.content.read()
-        log.msg("content size = %d" % len(content), level=DEBUG)
+        logger.debug("content size = %d", len(content))
         if content:
             return defer.succeed(json_decode(content))
         else:
@@ -41,7 +152,14 @@ class BaseService(Resource):
 
     def doResponse(self, value, request):
         request.setHeader("Content-Type", "application/json; charset=UTF-8")
-        if isinstance(value, Failure):
+        if isinstance(value, Failure) and value.check(Throttled):
+            reply = dict(error=str(value.value),
+                         retry_after=value.value.retry_after)
+            request.setResponseCode(429)
+            request.setHeader("Retry-After", str(value.value.retry_after))
+            request.write(json_encode(reply))
+
+        elif isinstance(value, Failure):
             reply = dict(error=str(value.value),
                          traceback=value.getTraceback())
             request.setResponseCode(500)
@@ -51,8 +169,8 @@ class BaseService(Resource):
             request.setResponseCode(200)
             request.write(json_encode(value))
 
-        log.msg("respone time: %.3fms" % (
-            (time.time() - self.startTime) * 1000), level=DEBUG)
+        logger.debug("respone time: %.3fms",
+                     (time.time() - self.startTime) * 1000)
 
         request.finish()
 
@@ -65,26 +183,307 @@ class MessageService(BaseService):
         self.clients = clients
         Resource.__init__(self, *args, **kwargs)
 
+    def _encodeMessage(self, message):
+        if not isinstance(message, dict):
+            raise TypeError("item must be a dict")
+        encoded_message = fix_message_encoding(message)
+        if not "servername" in encoded_message:
+            raise TypeError("servername not found")
+        if not "text" in encoded_message:
+            raise TypeError("text not found")
+        if not isinstance(encoded_message.get("priority", 0), (int, long)):
+            raise TypeError("priority must be an integer")
+        return encoded_message
+
+    def _retryAfter(self, servername, count, size, priority):
+        return self.clients[servername].mq_retry_after(count, size, priority)
+
     def sendMessage(self, messages):
         if not isinstance(messages, list):
             raise TypeError("input JSON must be a list")
 
+        servers = OrderedDict()
         for message in messages:
+            encoded_message = self._encodeMessage(message)
+            servername = encoded_message["servername"]
+            if servername not in self.clients:
+                continue
+            servers.setdefault(servername, list()).append(encoded_message)
+
+        # admit all messages or none of them
+        retry_after = 0
+        for servername, queued in servers.items():
+            size = sum(map(message_size, queued))
+            priority = min(x.get("priority", 0) for x in queued)
+            retry_after = max(retry_after,
+                              self._retryAfter(servername, len(queued),
+                                               size, priority))
+        if retry_after:
+            raise Throttled("message queue is full", retry_after)
+
+        commits = list()
+        for servername, queued in servers.items():
+            commits.append(self.clients[servername].enqueue(queued))
+        return self._committed(commits, None)
+
+    def _committed(self, commits, value):
+        """value, once journaled messages are on disk"""
+        commits = filter(None, commits)
+        if not commits:
+            return value
+        d = defer.gatherResults(commits, consumeErrors=True)
+        d.addCallback(lambda _: value)
+        return d
 
-            if not isinstance(message, dict):
-                raise TypeError("item must be a dict")
-            encoded_message = fix_message_encoding(message)
-            if not "servername" in encoded_message:
-                raise TypeError("servername not found")
-	    servername = encoded_message["servername"]
-	    if servername not in self.clients:
-		continue
-            self.clients[servername].protocol.mq_append(encoded_message)
-            self.clients[servername].protocol.schedule()
+    def _sendChunk(self, records, results, commits):
+        servers = OrderedDict()
+        for message, error in records:
+            if error is not None:
+                results.append(dict(status="rejected", error=error))
+                continue
+            try:
+                message = self._encodeMessage(message)
+                servername = message["servername"]
+                if servername not in self.clients:
+                    raise ValueError("unknown server: %s" % servername)
+            except (TypeError, ValueError) as e:
+                results.append(dict(status="rejected", error=str(e)))
+                continue
+
+            queued = servers.setdefault(servername, [list(), 0])
+            size = queued[1] + message_size(message)
+            retry_after = self._retryAfter(servername, len(queued[0]) + 1,
+                                           size, message.get("priority", 0))
+            if retry_after:
+                results.append(dict(status="throttled",
+                                    retry_after=retry_after))
+                continue
+
+            queued[0].append(message)
+            queued[1] = size
+            results.append(dict(status="accepted"))
+
+        # one enqueue and one schedule per server and chunk
+        for servername, queued in servers.items():
+            if queued[0]:
+                commits.append(self.clients[servername].enqueue(queued[0]))
+
+    def sendBatch(self, parser, request):
+        """summarize a batch queued while it arrived"""
+        results, commits = parser.results, parser.commits
+
+        accepted, throttled, retry_after = 0, 0, 0
+        for result in results:
+            if result["status"] == "accepted":
+                accepted += 1
+            elif result["status"] == "throttled":
+                throttled += 1
+                retry_after = max(retry_after, result["retry_after"])
+
+        if throttled and not accepted:
+            raise Throttled("message queue is full", retry_after)
+        if throttled:
+            request.setHeader("Retry-After", str(retry_after))
+
+        return self._committed(commits, dict(
+            accepted=accepted,
+            throttled=throttled,
+            rejected=len(results) - accepted - throttled,
+            results=results))
 
     def render_POST(self, request):
-        d = self.prepare(request)
+        ingest = getattr(request, "ingest", None)
+        if ingest is not None:
+            d = defer.succeed(ingest)
+            d.addCallback(self.sendBatch, request)
+        else:
+            d = self.prepare(request)
+            d.addCallback(self.sendMessage)
         request.notifyFinish().addErrback(self.doCancel, d)
-        d.addCallback(self.sendMessage)
         d.addBoth(self.doResponse, request)
         return NOT_DONE_YET
+
+
+class MetricsService(Resource):
+
+    isLeaf = True
+
+    def __init__(self, clients, workers, shards=None, *args, **kwargs):
+        self.clients = clients
+        self.workers = workers
+        self.shards = shards
+        Resource.__init__(self, *args, **kwargs)
+
+    def gauges(self, collected=()):
+        for servername, factory in sorted(self.clients.items()):
+            labels = (("server", servername),)
+            status = factory.status()
+            if not status:
+                continue
+            yield ("sabo_connected", labels, status["connected"])
+            yield ("sabo_held", labels, status["held"])
+            if "mq_depth" not in status:
+                continue
+            yield ("sabo_mq_depth", labels, status["mq_depth"])
+            yield ("sabo_mq_bytes", labels, status["mq_bytes"])
+            yield ("sabo_rq_depth", labels, status["rq_depth"])
+
+        if self.workers is not None:
+            for name, value in sorted(self.workers.stats().items()):
+                yield ("sabo_workers_%s" % name, (), value)
+
+        for data in collected:
+            labels = (("shard", data["shard"]),)
+            for name, value in sorted(data["workers"].items()):
+                yield ("sabo_workers_%s" % str(name), labels, value)
+
+    def _render(self, collected, request):
+        registry = Registry()
+        registry.merge(metrics.snapshot())
+        for data in collected:
+            registry.merge(data)
+        request.write(registry.render(self.gauges(collected)))
+        request.finish()
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", "text/plain; version=0.0.4")
+        if self.shards is None:
+            return metrics.render(self.gauges())
+
+        # counters and histograms live in the shard processes
+        d = self.shards.collect()
+        d.addCallback(self._render, request)
+        d.addErrback(self._complain, request)
+        return NOT_DONE_YET
+
+    def _complain(self, err, request):
+        log.err(err)
+        request.setResponseCode(500)
+        request.finish()
+
+
+class ProfileService(Resource):
+    """profiling windows of this process, or of every shard
+
+      POST   /profile?threads=reactor,workers&seconds=30   open one
+      DELETE /profile                                      close it early
+      GET    /profile                                      summary
+      GET    /profile/<threads>.pstats                     stats dump
+      GET    /profile/<shard>/<threads>.pstats             stats dump
+
+    With shards, the actions are run by all of them and their answers
+    are returned by shard index.
+    """
+
+    isLeaf = True
+
+    def __init__(self, profiler, shards=None, *args, **kwargs):
+        self.profiler = profiler
+        self.shards = shards
+        Resource.__init__(self, *args, **kwargs)
+
+    def _summary(self, request):
+        request.setHeader("Content-Type", "application/json; charset=UTF-8")
+        return json_encode(self.profiler.summary())
+
+    def _error(self, request, code, message):
+        request.setResponseCode(code)
+        request.setHeader("Content-Type", "application/json; charset=UTF-8")
+        return json_encode(dict(error=message))
+
+    def _sharded(self, request, action, **fields):
+        d = self.shards.profile(action, **fields)
+        d.addCallback(self._answers, request)
+        d.addErrback(self._complain, request)
+        return NOT_DONE_YET
+
+    def _answers(self, answers, request):
+        if not answers:
+            request.write(self._error(request, 503, "no shard attached"))
+            request.finish()
+            return
+
+        shards, codes = dict(), list()
+        for index, answer in answers.items():
+            if "error" in answer:
+                shards[index] = dict(error=answer["error"])
+                codes.append(answer["code"])
+                continue
+            summary = answer["data"]
+            for thread, stats in summary["stats"].items():
+                stats["dump"] = "%d/%s" % (index, stats["dump"])
+            shards[index] = summary
+
+        # an error only if no shard could do it
+        if len(codes) == len(answers):
+            request.setResponseCode(codes[0])
+        request.setHeader("Content-Type", "application/json; charset=UTF-8")
+        request.write(json_encode(dict(shards=shards)))
+        request.finish()
+
+    def _dumped(self, answers, request, index, thread):
+        answer = answers.get(index, None)
+        if answer is None:
+            request.write(self._error(request, 404, "no shard %d" % index))
+        elif "error" in answer:
+            request.write(self._error(request, answer["code"],
+                                      answer["error"]))
+        else:
+            request.setHeader("Content-Type", "application/octet-stream")
+            request.setHeader("Content-Disposition",
+                              'attachment; filename="sabo-%d-%s.pstats"' %
+                              (index, thread))
+            request.write(base64.b64decode(answer["data"]))
+        request.finish()
+
+    def _complain(self, err, request):
+        log.err(err)
+        request.setResponseCode(500)
+        request.finish()
+
+    def _dump(self, request, name):
+        shard, _, name = name.rpartition("/")
+        thread, _, ext = name.partition(".")
+        if self.shards is None and not shard:
+            if ext != "pstats" or thread not in self.profiler.stats:
+                return self._error(request, 404, "no stats for %s" % name)
+            request.setHeader("Content-Type", "application/octet-stream")
+            request.setHeader("Content-Disposition",
+                              'attachment; filename="sabo-%s-%d.pstats"' %
+                              (thread, self.profiler.started))
+            return self.profiler.dump(thread)
+
+        if self.shards is None or ext != "pstats" or not shard.isdigit():
+            return self._error(request, 404, "no stats for %s" % name)
+        d = self.shards.profile("dump", int(shard), thread=thread)
+        d.addCallback(self._dumped, request, int(shard), thread)
+        d.addErrback(self._complain, request)
+        return NOT_DONE_YET
+
+    def render_GET(self, request):
+        name = "/".join(request.postpath)
+        if name:
+            return self._dump(request, name)
+        if self.shards is not None:
+            return self._sharded(request, "summary")
+        return self._summary(request)
+
+    def render_POST(self, request):
+        threads = request.args.get("threads", ["reactor"])[0].split(",")
+        try:
+            seconds = float(request.args.get("seconds", [30])[0])
+            if self.shards is not None:
+                return self._sharded(request, "start", threads=threads,
+                                     seconds=seconds)
+            self.profiler.start(threads, seconds)
+        except ProfilerBusy as e:
+            return self._error(request, 409, str(e))
+        except ValueError as e:
+            return self._error(request, 400, str(e))
+        return self._summary(request)
+
+    def render_DELETE(self, request):
+        if self.shards is not None:
+            return self._sharded(request, "stop")
+        self.profiler.stop()
+        return self._summary(request)
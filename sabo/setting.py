@@ -1,49 +1,167 @@
 # -*- mode: python -*-
 
 from yaml import load as yaml_load
+try:
+    from yaml import CLoader as Loader
+except ImportError:
+    from yaml import Loader
 from twisted.python import log
+from sabo.dispatch import DispatchTable
+from sabo.cache import ResponseCache
+from sabo.rewrite import RewritePipeline
+from sabo.context import CONTEXT_FIELDS
+from sabo.scheduler import RateLimiter
+from ujson import encode as json_encode
 import re
-import codecs
+import hashlib
+import importlib
 
-__all__ = ["setting", "reload_setting"]
+__all__ = ["setting", "reload_setting", "read_setting", "commit_setting"]
 
 setting, yaml = None, None
 
+# compiled objects of the running configuration, reused by reloads
+_digest = None
+_patterns = dict()
+_handlers = dict()
+_ratelimit = None
+_plugins = dict()
+
 
 class ConfigError(Exception):
     pass
 
 
-def _compile_regex(v):
+def _compile_regex(v, patterns=None):
+    """compile match_ values, reusing patterns of the running
+    configuration and collecting the ones in use into patterns"""
     if isinstance(v[0], str) and v[0].startswith("match_"):
-        return (v[0], re.compile(v[1]))
+        if patterns is None:
+            patterns = dict()
+        if v[1] not in patterns:
+            patterns[v[1]] = _patterns.get(v[1], None) or re.compile(v[1])
+        return (v[0], patterns[v[1]])
     else:
         return v
 
 
-def compile_regex(v):
-    return dict(map(_compile_regex, v.items()))
+def compile_regex(v, patterns=None):
+    return dict(_compile_regex(x, patterns) for x in v.items())
 
 
-def reload_setting():
-    global setting
+def _diff(old, new):
+    """channels added and removed by a reload"""
+    old_channels, new_channels = set(old["channels"]), set(new["channels"])
+    return dict(added=sorted(new_channels - old_channels),
+                removed=sorted(old_channels - new_channels))
+
+
+def read_setting():
+    """read and compile the configuration without making it the running
+    one, may be called off the reactor thread"""
     log.msg("reloading configuration: %s" % yaml)
-    setting = _init(yaml)
-    return setting
+    try:
+        with open(yaml, "rb") as f:
+            content = f.read()
+        digest = hashlib.sha1(content).hexdigest()
+        if digest == _digest:
+            return dict(digest=digest)
+        return _init(content)
+    except Exception as e:
+        raise ConfigError("malformed configuration: %s" % str(e))
+
+
+def commit_setting(state):
+    """make what read_setting read the running configuration, return it
+    and what changed, None if nothing did"""
+    global setting, _digest, _handlers, _ratelimit, _patterns
+    if "setting" not in state:
+        return setting, None
+    old, setting = setting, state["setting"]
+    _digest, _handlers = state["digest"], state["handlers"]
+    _patterns = state["patterns"]
+    _ratelimit = state["ratelimit"]
+    if old is None:
+        return setting, None
+    return setting, _diff(old, setting)
+
+
+def reload_setting():
+    """reload the configuration, return it and what changed"""
+    return commit_setting(read_setting())
 
 
 def init(_yaml):
     global setting, yaml
     yaml = _yaml
-    setting = _init(_yaml)
-    return setting
-
-
-def _init(_yaml):
+    with open(yaml, "rb") as f:
+        content = f.read()
+    return commit_setting(_init(content))[0]
+
+
+def _compile_handler(item, patterns):
+    """compile a handler, reusing the one of an identical configuration"""
+    key = json_encode(item, sort_keys=True)
+    if key in _handlers:
+        for field, value in _handlers[key].items():
+            if isinstance(field, str) and field.startswith("match_"):
+                patterns[value.pattern] = value
+        return key, _handlers[key]
+
+    if "rewrites" in item:
+        item["rewrites"] = RewritePipeline(
+            [compile_regex(x, patterns) for x in item["rewrites"]])
+    if "cache" in item:
+        item["cache"] = ResponseCache.from_config(item["cache"])
+    if "context" in item:
+        unknown = set(item["context"]) - set(CONTEXT_FIELDS)
+        if unknown:
+            raise ValueError("unknown context fields: %s" %
+                             ", ".join(sorted(unknown)))
+        item["context"] = tuple(item["context"])
+    if "ratelimit" in item:
+        item["ratelimit"] = RateLimiter.from_config(item["ratelimit"])
+    if "python" in item:
+        item["python"] = load_plugin(item["python"])
+    return key, compile_regex(item, patterns)
+
+
+def load_plugin(spec):
+    """the callable named by `package.module:name', imported once"""
+    if spec not in _plugins:
+        module, _, name = spec.rpartition(":")
+        if not module:
+            module, _, name = spec.rpartition(".")
+        f = getattr(importlib.import_module(module), name)
+        if not callable(f):
+            raise TypeError("%s is not callable" % spec)
+        _plugins[spec] = f
+    return _plugins[spec]
+
+
+def _rate_limiter(config):
+    """per user limit over all handlers, kept while unchanged"""
+    key = json_encode(config, sort_keys=True)
+    if _ratelimit is None or _ratelimit[0] != key:
+        return (key, RateLimiter.from_config(dict(config, per="user")))
+    return _ratelimit
+
+
+def _dispatch_table(handlers, previous):
+    if previous is not None and len(previous.handlers) == len(handlers) and \
+       all(x is y for x, y in zip(previous.handlers, handlers)):
+        return previous
+    return DispatchTable(handlers)
+
+
+def _init(content):
+    """compiled configuration and the caches to keep along with it"""
     _setting = dict()
+    ratelimit = None
+    # only the patterns of this configuration are kept
+    patterns = dict()
 
-    with codecs.open(yaml, "r", encoding="utf-8") as f:
-        _setting = yaml_load(f.read())
+    _setting = yaml_load(content.decode("utf-8"), Loader=Loader)
 
     _setting["servers"] = dict(map(lambda x: (x["name"], x),
                                    _setting["servers"]))
@@ -52,18 +170,28 @@ def _init(_yaml):
         map(lambda x: ((x["server"], x["name"]), x), _setting["channels"]))
 
     if "users" in _setting:
-        _setting["users"] = map(compile_regex, _setting["users"])
+        _setting["users"] = [compile_regex(x, patterns)
+                             for x in _setting["users"]]
     else:
         _setting["users"] = list()
 
+    try:
+        if _setting.get("ratelimit", None):
+            ratelimit = _rate_limiter(_setting["ratelimit"])
+            _setting["ratelimit"] = ratelimit[1]
+        else:
+            _setting["ratelimit"] = None
+    except Exception as e:
+        raise ConfigError("malformed ratelimit configuration: %s" % str(e))
+
     # rearrange handlers' data structure
     try:
         h = dict(privmsg=list(), user_joined=list(), joined=list())
+        handlers = dict()
         for item in _setting["handlers"]:
-            if "rewrites" in item:
-                item["rewrites"] = map(compile_regex, item["rewrites"])
             if item["type"] in h:
-                data = dict(map(_compile_regex, item.items()))
+                key, data = _compile_handler(item, patterns)
+                handlers[key] = data
                 h[item["type"]].append(data)
             else:
                 log.msg("invalid message type: %s" % item["type"])
@@ -72,4 +200,14 @@ def _init(_yaml):
     except Exception as e:
         raise ConfigError("malformed handler configuration: %s" % str(e))
 
-    return _setting
+    # build dispatch tables and resolve candidates of configured channels
+    previous = setting["dispatch"] if setting else dict()
+    _setting["dispatch"] = dict(
+        map(lambda x: (x[0], _dispatch_table(x[1], previous.get(x[0]))),
+            _setting["handlers"].items()))
+    for table in _setting["dispatch"].values():
+        for servername, channel in _setting["channels"].keys():
+            table.candidates(servername, channel)
+
+    return dict(setting=_setting, handlers=handlers, ratelimit=ratelimit,
+                patterns=patterns, digest=hashlib.sha1(content).hexdigest())
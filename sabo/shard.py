@@ -0,0 +1,558 @@
+# -*- mode: python -*-
+
+"""
+Server connections sharded across processes.
+
+  shards:
+    processes: 4
+    socket: /tmp/sabo.sock    # default: a file in the temp directory
+
+With more than one process, `start' runs a coordinator owning the
+controller and spawns the shards, each connecting the servers assigned
+to it (round robin over the sorted names, or the server's `shard').
+They talk newline-delimited JSON over a unix socket:
+
+  hello     shard -> coordinator   shard index
+  status    shard -> coordinator   queue state of its servers
+  enqueue   both ways              messages for a server, forwarded by
+                                   the coordinator to the owning shard
+  committed shard -> coordinator   messages of an enqueue with an id
+                                   are in the journal
+  reload    both ways              one shard reloaded, the others follow
+  metrics   both ways              counters, histograms and worker stats
+  profile   both ways              profiler actions of /profile, run by
+                                   every shard, and their answers
+
+Connections of other shards appear in `siblings' as RemoteSibling, so
+redirects work unchanged. The controller admits messages based on the
+status last reported by the owning shard. Without the section, or with
+one process, everything runs in a single process as before. With a
+journal the controller answers once the owning shard committed the
+messages to it.
+
+"""
+
+from twisted.internet import reactor, protocol, defer, task
+from twisted.internet.error import ProcessExitedAlready
+from twisted.protocols.basic import LineReceiver
+from twisted.python.failure import Failure
+from twisted.python import log
+from ujson import encode as json_encode, decode as json_decode
+from sabo.util import fix_message_encoding, message_size
+from sabo.metrics import metrics
+from sabo.profiler import Profiler, ProfilerBusy
+from sabo.ircclient import reload_all
+from sabo import logger
+from collections import deque
+from logging import WARN
+
+import os
+import sys
+import math
+import base64
+import tempfile
+
+__all__ = ["RemoteSibling", "Coordinator", "ShardLink", "ShardLost",
+           "assign", "processes", "coordinate", "run_shard"]
+
+STATUS_INTERVAL = 1.0
+RESPAWN_DELAY = 1.0
+COLLECT_TIMEOUT = 2.0
+COMMIT_TIMEOUT = 30.0
+MAX_PENDING = 10000
+
+
+def processes(setting):
+    return int((setting.get("shards", None) or dict()).get("processes", 1))
+
+
+def assign(servers, count):
+    """shard index of every server"""
+    return dict((name, int(servers[name].get("shard", i)) % count)
+                for i, name in enumerate(sorted(servers)))
+
+
+class ShardLost(Exception):
+    pass
+
+
+class RemoteSibling(object):
+    """a connection owned by another process"""
+
+    protocol = None
+
+    def __init__(self, servername, router):
+        self.servername = servername
+        self.router = router
+
+    def enqueue(self, messages):
+        return self.router.enqueue(self.servername, messages)
+
+    def reconfigure(self, setting, changes):
+        # the owning shard reloads by itself
+        pass
+
+    def status(self):
+        return self.router.status.get(self.servername, None)
+
+    def mq_retry_after(self, count=1, size=0, priority=0):
+        status = self.status()
+        if not status:
+            return 0
+        lowest = status["lowest"]
+        if lowest is not None and priority > lowest:
+            return 0
+
+        excess = count - status["free"]
+        free_bytes = status["free_bytes"]
+        if free_bytes is not None and size > free_bytes:
+            average = max(size / float(count), 1)
+            excess = max(excess,
+                         int(math.ceil((size - free_bytes) / average)))
+        if excess <= 0:
+            return 0
+        if not status["rate"]:
+            return max(status.get("retry_after", 1), 1)
+        return int(math.ceil(excess / status["rate"]))
+
+
+class FrameProtocol(LineReceiver):
+    """newline-delimited JSON frames dispatched to frame_<op>"""
+
+    delimiter = "\n"
+    MAX_LENGTH = 1 << 26
+
+    def send(self, op, **fields):
+        fields["op"] = op
+        self.sendLine(json_encode(fields))
+
+    def lineReceived(self, line):
+        try:
+            frame = json_decode(line)
+            handler = getattr(self, "frame_%s" % frame["op"])
+        except (ValueError, KeyError, AttributeError):
+            log.msg("malformed frame dropped: %r" % line[:80], level=WARN)
+            return
+        handler(frame)
+
+    def lineLengthExceeded(self, line):
+        log.msg("frame too long, dropping connection", level=WARN)
+        self.transport.loseConnection()
+
+
+##########################################################################
+# Coordinator side
+##########################################################################
+
+class CoordinatorProtocol(FrameProtocol):
+
+    shard = None
+
+    def frame_hello(self, frame):
+        self.shard = frame["shard"]
+        self.factory.attach(self)
+
+    def frame_status(self, frame):
+        self.factory.status.update(
+            (k.encode("UTF-8"), v) for k, v in frame["servers"].items())
+
+    def frame_enqueue(self, frame):
+        # relayed by a shard, nobody waits for them
+        self.factory.enqueue(frame["servername"].encode("UTF-8"),
+                             frame["messages"], commit=False)
+
+    def frame_committed(self, frame):
+        self.factory.committed(frame["id"], frame.get("error", None))
+
+    def frame_reload(self, frame):
+        self.factory.reloaded(self.shard)
+
+    def frame_metrics(self, frame):
+        self.factory.collected(frame["id"], frame["data"])
+
+    def frame_profile(self, frame):
+        self.factory.collected(frame["id"], frame)
+
+    def connectionLost(self, reason):
+        self.factory.detach(self)
+
+
+class ShardProcess(protocol.ProcessProtocol):
+
+    def __init__(self, coordinator, index):
+        self.coordinator = coordinator
+        self.index = index
+
+    def processEnded(self, reason):
+        self.coordinator.ended(self.index, reason)
+
+
+class Coordinator(protocol.ServerFactory):
+
+    protocol = CoordinatorProtocol
+
+    def __init__(self, yaml, setting, path):
+        self.yaml = yaml
+        self.path = path
+        self.count = processes(setting)
+        self.owners = assign(setting["servers"], self.count)
+        self.shards = dict()
+        self.pending = dict((i, deque()) for i in range(self.count))
+        self.journaled = bool(setting.get("journal", None))
+        self.status = dict()
+        self.processes = dict()
+        self.stopping = False
+        self._requests = dict()
+        self._commits = dict()
+        self._next_id = 0
+        reactor.addSystemEventTrigger("before", "shutdown", self.stop)
+
+    def spawn(self, index):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(
+            filter(None, [root, env.get("PYTHONPATH", None)]))
+        args = [sys.executable, "-m", "sabo.shard",
+                self.yaml, str(index), self.path]
+        log.msg("starting shard %d" % index)
+        self.processes[index] = reactor.spawnProcess(
+            ShardProcess(self, index), sys.executable, args, env=env,
+            childFDs={1: 1, 2: 2})
+
+    def ended(self, index, reason):
+        self.processes.pop(index, None)
+        if self.stopping:
+            return
+        log.msg("shard %d exited: %s, restarting" %
+                (index, reason.getErrorMessage()), level=WARN)
+        reactor.callLater(RESPAWN_DELAY, self.spawn, index)
+
+    def stop(self):
+        self.stopping = True
+        for process in self.processes.values():
+            try:
+                process.signalProcess("TERM")
+            except ProcessExitedAlready:
+                pass
+
+    def attach(self, shard):
+        log.msg("shard %d attached" % shard.shard)
+        self.shards[shard.shard] = shard
+        pending = self.pending.get(shard.shard, ())
+        while pending:
+            shard.send("enqueue", **pending.popleft())
+
+    def detach(self, shard):
+        if self.shards.get(shard.shard) is shard:
+            log.msg("shard %d detached" % shard.shard, level=WARN)
+            del self.shards[shard.shard]
+
+            # what was sent may or may not have been journaled
+            waiting = set(x.get("id", None)
+                          for x in self.pending[shard.shard])
+            for request_id, (index, d) in self._commits.items():
+                if index == shard.shard and request_id not in waiting:
+                    d.errback(ShardLost("shard %d detached" % index))
+
+    def enqueue(self, servername, messages, commit=True):
+        """forward messages to the owning shard. With a journal, return a
+        Deferred firing once the shard committed them"""
+        index = self.owners.get(servername, None)
+        if index is None:
+            log.msg("no shard owns %s, messages dropped" % servername,
+                    level=WARN)
+            return
+
+        # account for them until the shard reports again
+        status = self.status.get(servername, None)
+        if status:
+            status["free"] -= len(messages)
+            if status["free_bytes"] is not None:
+                status["free_bytes"] -= sum(map(message_size, messages))
+
+        fields = dict(servername=servername, messages=messages)
+        d = None
+        if commit and self.journaled:
+            self._next_id += 1
+            fields["id"] = request_id = self._next_id
+            d = defer.Deferred()
+            self._commits[request_id] = (index, d)
+            d.addTimeout(COMMIT_TIMEOUT, reactor)
+            d.addBoth(self._uncommit, request_id)
+
+        shard = self.shards.get(index, None)
+        if shard is not None:
+            shard.send("enqueue", **fields)
+        elif len(self.pending[index]) < MAX_PENDING:
+            self.pending[index].append(fields)
+        else:
+            log.msg("shard %d is away and its backlog is full, "
+                    "messages dropped" % index, level=WARN)
+            if d is not None:
+                d.errback(ShardLost("shard %d is away" % index))
+        return d
+
+    def _uncommit(self, value, request_id):
+        self._commits.pop(request_id, None)
+        return value
+
+    def committed(self, request_id, error):
+        index, d = self._commits.pop(request_id, (None, None))
+        if d is None:
+            return
+        if error is None:
+            d.callback(None)
+        else:
+            d.errback(ShardLost(error))
+
+    def reloaded(self, origin):
+        for index, shard in self.shards.items():
+            if index != origin:
+                shard.send("reload")
+
+    def _ask(self, shard, op, **fields):
+        """send a request to a shard, Deferred of its answer"""
+        self._next_id += 1
+        request_id = self._next_id
+        d = defer.Deferred()
+        self._requests[request_id] = d
+        shard.send(op, id=request_id, **fields)
+        d.addTimeout(COLLECT_TIMEOUT, reactor)
+        d.addBoth(self._forget, request_id)
+        return d
+
+    def collect(self):
+        """metrics snapshots of the attached shards"""
+        ds = list()
+        for shard in self.shards.values():
+            d = self._ask(shard, "metrics")
+            d.addErrback(lambda err: None)
+            ds.append(d)
+        d = defer.gatherResults(ds)
+        d.addCallback(lambda results: filter(None, results))
+        return d
+
+    def profile(self, action, index=None, **fields):
+        """run a profiler action on the attached shards, or on shard index
+        only, Deferred of the answer frames by shard index"""
+        indexes = sorted(self.shards) if index is None else \
+            [x for x in (index,) if x in self.shards]
+        ds = list()
+        for i in indexes:
+            d = self._ask(self.shards[i], "profile", action=action, **fields)
+            d.addErrback(lambda err, i=i: dict(
+                code=504, error="shard %d did not answer" % i))
+            ds.append(d)
+        d = defer.gatherResults(ds)
+        d.addCallback(lambda answers: dict(zip(indexes, answers)))
+        return d
+
+    def _forget(self, value, request_id):
+        self._requests.pop(request_id, None)
+        return value
+
+    def collected(self, request_id, data):
+        d = self._requests.pop(request_id, None)
+        if d is not None:
+            d.callback(data)
+
+
+def coordinate(yaml, setting):
+    """listen on the controller port and run the shards"""
+    from sabo import _listen
+    config = setting.get("shards", None) or dict()
+    path = config.get("socket", None) or \
+        os.path.join(tempfile.gettempdir(), "sabo-%d.sock" % os.getpid())
+    if os.path.exists(path):
+        os.unlink(path)
+
+    coordinator = Coordinator(yaml, setting, path)
+    reactor.listenUNIX(path, coordinator)
+    clients = dict((name, RemoteSibling(name, coordinator))
+                   for name in setting["servers"])
+    _listen(setting, clients, None, coordinator)
+    for index in range(coordinator.count):
+        coordinator.spawn(index)
+    return coordinator
+
+
+##########################################################################
+# Shard side
+##########################################################################
+
+class ShardProtocol(FrameProtocol):
+
+    def connectionMade(self):
+        self.factory.attached(self)
+
+    def connectionLost(self, reason):
+        self.factory.detached(self)
+
+    def frame_enqueue(self, frame):
+        d = defer.maybeDeferred(self.factory.deliver,
+                                frame["servername"].encode("UTF-8"),
+                                frame["messages"])
+        if "id" not in frame:
+            return
+
+        def __done(value):
+            if isinstance(value, Failure):
+                self.send("committed", id=frame["id"],
+                          error=value.getErrorMessage())
+            else:
+                self.send("committed", id=frame["id"])
+
+        d.addBoth(__done)
+
+    def frame_reload(self, frame):
+        self.factory.reload()
+
+    def frame_metrics(self, frame):
+        self.send("metrics", id=frame["id"], data=self.factory.metrics())
+
+    def frame_profile(self, frame):
+        try:
+            data = self.factory.profile(frame)
+        except ProfilerBusy as e:
+            self.send("profile", id=frame["id"], code=409, error=str(e))
+        except KeyError as e:
+            self.send("profile", id=frame["id"], code=404,
+                      error="no stats for %s" % e.args[0])
+        except ValueError as e:
+            self.send("profile", id=frame["id"], code=400, error=str(e))
+        else:
+            self.send("profile", id=frame["id"], data=data)
+
+
+class ShardLink(protocol.ReconnectingClientFactory):
+
+    protocol = ShardProtocol
+    maxDelay = 5
+
+    def __init__(self, index, siblings, workers):
+        self.index = index
+        self.siblings = siblings
+        self.workers = workers
+        self.profiler = Profiler(workers)
+        self.status = dict()
+        self.connection = None
+        self.pending = deque()
+        self._reporter = task.LoopingCall(self.report)
+
+    def local(self):
+        return dict((k, v) for k, v in self.siblings.items()
+                    if not isinstance(v, RemoteSibling))
+
+    def attached(self, connection):
+        self.resetDelay()
+        self.connection = connection
+        connection.send("hello", shard=self.index)
+        while self.pending:
+            op, fields = self.pending.popleft()
+            connection.send(op, **fields)
+        self.report()
+        if not self._reporter.running:
+            self._reporter.start(STATUS_INTERVAL, now=False)
+
+    def detached(self, connection):
+        if self.connection is connection:
+            self.connection = None
+
+    def _send(self, op, **fields):
+        if self.connection is not None:
+            self.connection.send(op, **fields)
+        elif len(self.pending) < MAX_PENDING:
+            self.pending.append((op, fields))
+        else:
+            log.msg("coordinator is away and the backlog is full, "
+                    "%s dropped" % op, level=WARN)
+
+    def enqueue(self, servername, messages):
+        self._send("enqueue", servername=servername, messages=messages)
+
+    def reloaded(self):
+        self._send("reload")
+
+    def reload(self):
+        reload_all(self.local())
+
+    def deliver(self, servername, messages):
+        """queue messages of a local server, see IRCClientFactory.enqueue"""
+        factory = self.siblings.get(servername, None)
+        if factory is None or isinstance(factory, RemoteSibling):
+            message = "%s is not on shard %d, messages dropped" % \
+                (servername, self.index)
+            log.msg(message, level=WARN)
+            return defer.fail(ShardLost(message))
+        return factory.enqueue(map(fix_message_encoding, messages))
+
+    def report(self):
+        if self.connection is not None:
+            self.connection.send("status", servers=dict(
+                (name, f.status()) for name, f in self.local().items()))
+
+    def metrics(self):
+        return dict(metrics.snapshot(), shard=self.index,
+                    workers=self.workers.stats())
+
+    def profile(self, frame):
+        """run a profiler action asked for by the coordinator"""
+        action = frame["action"]
+        if action == "start":
+            self.profiler.start(frame["threads"], frame["seconds"])
+        elif action == "stop":
+            self.profiler.stop()
+        elif action == "dump":
+            thread = frame["thread"].encode("UTF-8")
+            if thread not in self.profiler.stats:
+                raise KeyError(thread)
+            return base64.b64encode(self.profiler.dump(thread))
+        elif action != "summary":
+            raise ValueError("unknown profiler action: %s" % action)
+        return self.profiler.summary()
+
+
+def run_shard(yaml, index, path):
+    """connect the servers of shard `index' and attach to the coordinator"""
+    from sabo import _init, _connect
+    from sabo.webclient import WebClient
+    from sabo.workers import WorkerPool
+
+    setting = _init(yaml)
+    owners = assign(setting["servers"], processes(setting))
+    webclient = WebClient(setting.get("http", None))
+    workers = WorkerPool(setting.get("workers", None))
+
+    siblings = dict()
+    link = ShardLink(index, siblings, workers)
+    for name, owner in owners.items():
+        if owner != index:
+            siblings[name] = RemoteSibling(name, link)
+    _connect([name for name, owner in sorted(owners.items())
+              if owner == index], siblings, webclient, workers, link)
+    reactor.connectUNIX(path, link)
+    return siblings
+
+
+def main(argv):
+    yaml, index, path = argv[1], int(argv[2]), argv[3]
+    logger.start(sys.stdout)
+    run_shard(yaml, index, path)
+
+    # do not outlive the coordinator
+    parent = os.getppid()
+
+    def __orphaned():
+        if os.getppid() != parent:
+            log.msg("coordinator is gone, stopping", level=WARN)
+            reactor.stop()
+
+    task.LoopingCall(__orphaned).start(STATUS_INTERVAL, now=False)
+    reactor.run()
+
+
+if __name__ == "__main__":
+    from sabo.shard import main
+    main(sys.argv)
+
+# vim: ts=4 sw=4 ai et
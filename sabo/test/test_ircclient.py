@@ -0,0 +1,111 @@
+# -*- mode: python -*-
+
+"""
+Pacing of outbound lines against a fake clock.
+"""
+
+from twisted.trial import unittest
+from twisted.internet import task
+from twisted.test.proto_helpers import StringTransport
+from sabo import ircclient, scheduler, setting
+from sabo.ircclient import IRCClient, JOINED
+
+CONFIG = """
+servers:
+  - name: test
+    host: localhost
+    port: 6667
+    nick: sabo
+    linerate: 1
+    burst: 2
+    schedule_interval: 0
+    max_targets: 1
+profile: {}
+channels: []
+handlers: []
+"""
+
+
+class FakeTime(object):
+
+    def __init__(self, clock):
+        self.time = clock.seconds
+
+
+class FakeFactory(object):
+
+    state = JOINED
+
+    def __init__(self):
+        self.siblings = dict()
+
+    def journal_append(self, data):
+        pass
+
+    def journal_done(self, data):
+        pass
+
+
+class WireTransport(StringTransport):
+    """remembers when each line was written"""
+
+    def __init__(self, clock):
+        StringTransport.__init__(self)
+        self.clock = clock
+        self.lines = list()
+
+    def write(self, data):
+        for line in data.splitlines():
+            self.lines.append((self.clock.seconds(), line))
+
+
+class PacingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+        self.patch(ircclient, "reactor", self.clock)
+        self.patch(ircclient, "time", FakeTime(self.clock))
+        self.patch(scheduler, "time", FakeTime(self.clock))
+        self.patch(setting, "setting",
+                   setting._init(CONFIG)["setting"])
+        self.client = IRCClient(FakeFactory(), "test")
+        self.client.transport = WireTransport(self.clock)
+
+    def tearDown(self):
+        call = self.client._schedule_call
+        if call is not None and call.active():
+            call.cancel()
+
+    def _wire(self, seconds):
+        start = self.clock.seconds()
+        self.client.schedule()
+        self.clock.pump([0.1] * int(seconds * 10))
+        return [(t - start, line) for t, line in self.client.transport.lines]
+
+    def test_multiline_paced(self):
+        """lines of one message are written at linerate after the burst"""
+        users = [u"user%d" % i for i in xrange(8)]
+        self.client.mq_append(dict(text=[u"hello"], users=users))
+        lines = self._wire(10)
+
+        self.assertEqual(len(lines), 8)
+        for i, (t, line) in enumerate(lines):
+            self.assertTrue(line.startswith("PRIVMSG user"))
+            self.assertTrue(t >= i - 1 - 1e-6, (i, t))
+
+    def test_quiet_channel_interleaved(self):
+        """a busy message does not hold back the next target"""
+        users = [u"user%d" % i for i in xrange(8)]
+        self.client.mq_append(dict(text=[u"hello"], users=users))
+        self.client.mq_append(dict(text=[u"quiet"], channels=[u"#quiet"]))
+        lines = self._wire(12)
+
+        self.assertEqual(len(lines), 9)
+        quiet = [t for t, line in lines if line.startswith("PRIVMSG #quiet")]
+        self.assertEqual(len(quiet), 1)
+        self.assertTrue(quiet[0] <= 1.0 + 1e-6, quiet)
+        for i, (t, line) in enumerate(lines):
+            self.assertTrue(t >= i - 1 - 1e-6, (i, t))
+
+# vim: ts=4 sw=4 ai et
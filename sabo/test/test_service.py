@@ -0,0 +1,70 @@
+# -*- mode: python -*-
+
+"""
+Streaming ingest of newline-delimited JSON.
+"""
+
+from twisted.trial import unittest
+from twisted.web.resource import Resource
+from twisted.test.proto_helpers import StringTransport
+from sabo.service import MessageService, IngestSite, NDJSON
+
+
+class FakeClient(object):
+
+    def __init__(self):
+        self.queued = list()
+
+    def mq_retry_after(self, count=1, size=0, priority=0):
+        return 0
+
+    def enqueue(self, messages):
+        self.queued.extend(messages)
+
+
+RECORD = '{"servername":"test","channels":["#sabo"],"text":["hi"]}\n'
+
+
+class IngestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = FakeClient()
+        root = Resource()
+        message = MessageService(dict(test=self.client))
+        root.putChild("message", message)
+        self.site = IngestSite(root, {"/message": message})
+        self.channel = self.site.buildProtocol(None)
+        self.transport = StringTransport()
+        self.channel.makeConnection(self.transport)
+
+    def tearDown(self):
+        self.channel.connectionLost(None)
+
+    def _headers(self, method, length):
+        return ("%s /message HTTP/1.1\r\n"
+                "Host: localhost\r\n"
+                "Content-Type: %s\r\n"
+                "Content-Length: %d\r\n\r\n" % (method, NDJSON, length))
+
+    def test_post_streamed(self):
+        """records are queued before the body is complete"""
+        body = RECORD * 2
+        self.channel.dataReceived(self._headers("POST", len(body)) + RECORD)
+        self.assertEqual(len(self.client.queued), 1)
+        self.assertEqual(self.transport.value(), "")
+
+        self.channel.dataReceived(RECORD)
+        self.assertEqual(len(self.client.queued), 2)
+        self.assertTrue(self.transport.value().startswith(
+            "HTTP/1.1 200 "))
+        self.assertIn('"accepted":2', self.transport.value())
+
+    def test_put_not_queued(self):
+        """a method other than POST is refused without queueing"""
+        body = RECORD * 2
+        self.channel.dataReceived(self._headers("PUT", len(body)) + body)
+        self.assertEqual(self.client.queued, [])
+        status = self.transport.value().split(" ", 2)[1]
+        self.assertIn(status, ("405", "501"))
+
+# vim: ts=4 sw=4 ai et
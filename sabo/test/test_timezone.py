@@ -0,0 +1,66 @@
+# -*- mode: python -*-
+
+"""
+Zone offsets read from the tz database.
+"""
+
+from twisted.trial import unittest
+from sabo.timezone import Rule, zone, ZONEINFO
+from sabo import plugins
+
+import os
+import calendar
+
+
+def utc(*fields):
+    return calendar.timegm(fields + (0,) * (6 - len(fields)))
+
+
+class ZoneTest(unittest.TestCase):
+
+    def setUp(self):
+        if not os.path.isdir(ZONEINFO):
+            raise unittest.SkipTest("no tz database in %s" % ZONEINFO)
+
+    def test_transitions(self):
+        new_york = zone("America/New_York")
+        self.assertEqual(new_york.at(utc(2026, 1, 15)), (-18000, "EST"))
+        self.assertEqual(new_york.at(utc(2026, 3, 8, 6, 59, 59)),
+                         (-18000, "EST"))
+        self.assertEqual(new_york.at(utc(2026, 3, 8, 7)), (-14400, "EDT"))
+        self.assertEqual(zone("Asia/Shanghai").at(utc(2026, 7, 1)),
+                         (28800, "CST"))
+
+    def test_rule(self):
+        """times after the last transition follow the footer"""
+        self.assertEqual(zone("America/Chicago").at(utc(2050, 7, 1)),
+                         (-18000, "CDT"))
+        self.assertEqual(zone("Australia/Sydney").at(utc(2050, 1, 1)),
+                         (39600, "AEDT"))
+        self.assertEqual(zone("Australia/Sydney").at(utc(2050, 7, 1)),
+                         (36000, "AEST"))
+
+    def test_clock(self):
+        """the process timezone is left alone"""
+        saved = os.environ.get("TZ", None)
+        text = plugins.clock(dict(), dict())["text"][0]
+        self.assertEqual(os.environ.get("TZ", None), saved)
+        for tz in plugins.TIMEZONES:
+            self.assertIn("(%s)" % tz, text)
+
+
+class RuleTest(unittest.TestCase):
+
+    def test_posix(self):
+        rule = Rule("EST5EDT,M3.2.0,M11.1.0")
+        self.assertEqual(rule.at(utc(2031, 3, 9, 6, 59, 59)),
+                         (-18000, "EST"))
+        self.assertEqual(rule.at(utc(2031, 3, 9, 7)), (-14400, "EDT"))
+        self.assertEqual(rule.at(utc(2031, 11, 2, 5, 59, 59)),
+                         (-14400, "EDT"))
+        self.assertEqual(rule.at(utc(2031, 11, 2, 6)), (-18000, "EST"))
+
+    def test_fixed(self):
+        self.assertEqual(Rule("<+0330>-3:30").at(0), (12600, "+0330"))
+
+# vim: ts=4 sw=4 ai et
@@ -0,0 +1,150 @@
+# -*- mode: python -*-
+
+"""
+Time zones of the tz database, read from its TZif files.
+
+Zone(name).at(t) tells the UTC offset and the abbreviation in effect at
+unix time t without touching TZ or calling time.tzset, which would
+change the timezone of the whole process, threads included. Times after
+the last transition of a file follow the POSIX TZ rule in its footer,
+of the M<month>.<week>.<day> form all zones of the database use.
+
+"""
+
+from bisect import bisect_right
+
+import os
+import re
+import time
+import struct
+import calendar
+
+__all__ = ["Zone", "zone", "ZONEINFO"]
+
+ZONEINFO = "/usr/share/zoneinfo"
+
+_HEADER = struct.Struct(">4sc15x6l")
+_POSIX_RE = re.compile(
+    r"^(?P<std><[^>]*>|[A-Za-z]+)(?P<stdoff>[+-]?[\d:]+)"
+    r"(?:(?P<dst><[^>]*>|[A-Za-z]+)(?P<dstoff>[+-]?[\d:]+)?"
+    r",M(?P<start>\d+\.\d\.\d)(?:/(?P<starttime>[+-]?[\d:]+))?"
+    r",M(?P<end>\d+\.\d\.\d)(?:/(?P<endtime>[+-]?[\d:]+))?)?$")
+
+# zones read so far by name
+_zones = dict()
+
+
+def _seconds(value):
+    """seconds of a [+-]hh[:mm[:ss]] field"""
+    sign = -1 if value.startswith("-") else 1
+    parts = [int(x) for x in value.lstrip("+-").split(":")]
+    parts += [0] * (3 - len(parts))
+    return sign * (parts[0] * 3600 + parts[1] * 60 + parts[2])
+
+
+def _name(value):
+    return value.strip("<>")
+
+
+class Rule(object):
+    """a POSIX TZ rule such as EST5EDT,M3.2.0,M11.1.0"""
+
+    def __init__(self, spec):
+        m = _POSIX_RE.match(spec)
+        if m is None:
+            raise ValueError("unsupported TZ rule: %s" % spec)
+        # POSIX offsets count west of Greenwich
+        self.std = (-_seconds(m.group("stdoff")), _name(m.group("std")))
+        self.dst = None
+        if m.group("dst"):
+            offset = -_seconds(m.group("dstoff")) if m.group("dstoff") \
+                else self.std[0] + 3600
+            self.dst = (offset, _name(m.group("dst")))
+            self.start = ([int(x) for x in m.group("start").split(".")],
+                          _seconds(m.group("starttime") or "2"))
+            self.end = ([int(x) for x in m.group("end").split(".")],
+                        _seconds(m.group("endtime") or "2"))
+
+    def _transition(self, year, when, offset):
+        """unix time of a M<month>.<week>.<day> change in year, given in
+        local time of offset"""
+        (month, week, day), seconds = when
+        first, days = calendar.monthrange(year, month)
+        # monthrange counts from Monday, the rule from Sunday
+        mday = 1 + (day - (first + 1)) % 7 + (week - 1) * 7
+        if mday > days:
+            mday -= 7
+        return calendar.timegm((year, month, mday, 0, 0, 0)) + \
+            seconds - offset
+
+    def at(self, t):
+        if self.dst is None:
+            return self.std
+        year = time.gmtime(t + self.std[0]).tm_year
+        start = self._transition(year, self.start, self.std[0])
+        end = self._transition(year, self.end, self.dst[0])
+        if start < end:
+            summer = start <= t < end
+        else:
+            # southern hemisphere, summer spans the new year
+            summer = not end <= t < start
+        return self.dst if summer else self.std
+
+
+class Zone(object):
+
+    def __init__(self, name, path=ZONEINFO):
+        self.name = name
+        with open(os.path.join(path, name), "rb") as f:
+            self._parse(f.read())
+
+    def _parse(self, data):
+        magic, version, isutcnt, isstdcnt, leapcnt, timecnt, typecnt, \
+            charcnt = _HEADER.unpack_from(data)
+        if magic != "TZif":
+            raise ValueError("%s is not a TZif file" % self.name)
+
+        pos, size, form = _HEADER.size, 4, "l"
+        if version >= "2":
+            # skip the 32 bit data for the 64 bit one following it
+            pos += timecnt * 5 + typecnt * 6 + charcnt + leapcnt * 8 + \
+                isstdcnt + isutcnt
+            magic, version, isutcnt, isstdcnt, leapcnt, timecnt, typecnt, \
+                charcnt = _HEADER.unpack_from(data, pos)
+            pos, size, form = pos + _HEADER.size, 8, "q"
+
+        self.times = struct.unpack_from(">%d%s" % (timecnt, form), data, pos)
+        pos += timecnt * size
+        indexes = struct.unpack_from(">%dB" % timecnt, data, pos)
+        pos += timecnt
+        types = [struct.unpack_from(">lBB", data, pos + i * 6)
+                 for i in xrange(typecnt)]
+        pos += typecnt * 6
+        chars = data[pos:pos + charcnt]
+        pos += charcnt + leapcnt * (size + 4) + isstdcnt + isutcnt
+
+        types = [(offset, chars[i:chars.index("\0", i)])
+                 for offset, isdst, i in types]
+        self.types = [types[i] for i in indexes]
+        # before the first transition, the first type applies
+        self.initial = types[0]
+
+        footer = data[pos:].strip("\n") if size == 8 else ""
+        self.rule = Rule(footer) if footer else None
+
+    def at(self, t):
+        """(UTC offset in seconds, abbreviation) at unix time t"""
+        if self.rule is not None and (not self.times or
+                                      t >= self.times[-1]):
+            return self.rule.at(t)
+        i = bisect_right(self.times, t)
+        return self.types[i - 1] if i else self.initial
+
+
+def zone(name):
+    """the zone of name, read once"""
+    if name not in _zones:
+        _zones[name] = Zone(name)
+    return _zones[name]
+
+# vim: ts=4 sw=4 ai et
@@ -1,14 +1,39 @@
-__all__ = ["fix_message_encoding"]
+__all__ = ["fix_message_encoding", "message_size"]
+
+# message keys come from a small fixed vocabulary, remember their encoding
+_keys = dict()
+
+
+def _encode_key(key):
+    if key in _keys:
+        return _keys[key]
+    fixed = key.encode("UTF-8") if isinstance(key, unicode) else key
+    if len(_keys) < 256:
+        _keys[key] = fixed
+    return fixed
+
+
+def _encode_list(items):
+    return [x.encode("UTF-8") if isinstance(x, unicode) else x
+            for x in items]
 
 
 def fix_message_encoding(message):
-    fixed = dict(map(lambda v: (v[0].encode("UTF-8"), v[1]), message.items()))
+    fixed = dict()
+    for key, value in message.iteritems():
+        fixed[_encode_key(key)] = value
 
     if "channels" in fixed:
-        fixed["channels"] = map(lambda x: x.encode("UTF-8"), fixed["channels"])
+        fixed["channels"] = _encode_list(fixed["channels"])
     if "users" in fixed:
-        fixed["users"] = map(lambda x: x.encode("UTF-8"), fixed["users"])
+        fixed["users"] = _encode_list(fixed["users"])
 
     return fixed
 
-# vim: ts=4 sw=4 ai et   
+
+def message_size(message):
+    """bytes of text a message will put on the wire"""
+    return sum(len(x.encode("UTF-8")) if isinstance(x, unicode) else len(x)
+               for x in message.get("text", ()))
+
+# vim: ts=4 sw=4 ai et
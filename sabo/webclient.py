@@ -0,0 +1,185 @@
+# -*- mode: python -*-
+
+"""
+Shared HTTP client for webhook handlers and rewrites.
+
+All connections of a process go through one keep-alive connection pool,
+so repeated calls to the same local services reuse their TCP connections.
+Concurrent requests are capped per host.
+
+stream() accepts newline-delimited JSON (application/x-ndjson) as well:
+each line is handed over as soon as it arrived instead of once the whole
+body did. Its timeout then bounds the wait for the headers and for each
+following line, not the whole response.
+
+"""
+
+from twisted.internet import reactor, defer, protocol
+from twisted.web.client import Agent, HTTPConnectionPool, FileBodyProducer
+from twisted.web.client import ResponseDone, PotentialDataLoss, readBody
+from twisted.web.http_headers import Headers
+from twisted.web import error
+from twisted.python import log
+from urlparse import urlparse
+from cStringIO import StringIO
+
+__all__ = ["WebClient", "STREAM_TYPES"]
+
+STREAM_TYPES = ("application/x-ndjson", "application/jsonl")
+MAX_LINE = 1 << 20
+
+
+class LineStream(protocol.Protocol):
+    """hand over each line of a response body as it arrives"""
+
+    def __init__(self, received, finished, timeout):
+        self.received = received
+        self.finished = finished
+        self.timeout = timeout
+        self.lines = 0
+        self._buffer = list()
+        self._size = 0
+        self._timer = None
+        self._timed_out = False
+
+    def connectionMade(self):
+        self._timer = reactor.callLater(self.timeout, self._expire)
+
+    def _expire(self):
+        self._timer = None
+        self._timed_out = True
+        self.transport.stopProducing()
+
+    def _line(self, line):
+        if not line.strip():
+            return
+        self.lines += 1
+        try:
+            self.received(line)
+        except Exception:
+            log.err(None, "failed to handle streamed line")
+
+    def dataReceived(self, data):
+        if self._timer is not None:
+            self._timer.reset(self.timeout)
+        lines = data.split("\n")
+        if len(lines) > 1:
+            self._buffer.append(lines[0])
+            lines[0] = "".join(self._buffer)
+            self._buffer, self._size = list(), 0
+            for line in lines[:-1]:
+                self._line(line)
+        if lines[-1]:
+            self._buffer.append(lines[-1])
+            self._size += len(lines[-1])
+            if self._size > MAX_LINE:
+                log.msg("streamed line exceeds %d bytes" % MAX_LINE)
+                self._cancel()
+                self.transport.stopProducing()
+
+    def _cancel(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def connectionLost(self, reason):
+        self._cancel()
+        if self._timed_out:
+            self.finished.errback(defer.TimeoutError("stream idle"))
+        elif reason.check(ResponseDone, PotentialDataLoss):
+            self._line("".join(self._buffer))
+            self.finished.callback(self.lines)
+        else:
+            self.finished.errback(reason)
+
+
+class WebClient(object):
+
+    def __init__(self, config=None):
+        config = config or dict()
+        self.max_per_host = config.get("max_per_host", 8)
+        self.timeout = config.get("timeout", 30)
+        self.connect_timeout = config.get("connect_timeout", 10)
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = config.get("persistent_per_host",
+                                                    self.max_per_host)
+        self.pool.cachedConnectionTimeout = config.get("idle_timeout", 240)
+        self._agents = dict()
+        self._hosts = dict()
+
+    def _agent(self, connect_timeout):
+        if connect_timeout not in self._agents:
+            self._agents[connect_timeout] = Agent(
+                reactor, connectTimeout=connect_timeout, pool=self.pool)
+        return self._agents[connect_timeout]
+
+    def _semaphore(self, url):
+        host = urlparse(url).netloc
+        if host not in self._hosts:
+            self._hosts[host] = defer.DeferredSemaphore(self.max_per_host)
+        return self._hosts[host]
+
+    def _request(self, url, postdata, timeout, connect_timeout,
+                 received=None):
+        headers = Headers({"Content-Type": ["application/json"]})
+        body = FileBodyProducer(StringIO(postdata)) \
+            if postdata is not None else None
+        if received is not None:
+            headers.setRawHeaders("Accept", [", ".join(STREAM_TYPES) +
+                                             ", application/json"])
+        d = self._agent(connect_timeout).request("POST", url, headers, body)
+        if received is None:
+            d.addCallback(self._read, url)
+            d.addTimeout(timeout, reactor)
+        else:
+            d.addTimeout(timeout, reactor)
+            d.addCallback(self._read_stream, url, received, timeout)
+        return d
+
+    def _read(self, response, url):
+        d = readBody(response)
+        if response.code >= 400:
+            def __fail(body):
+                raise error.Error(response.code, response.phrase, body)
+            d.addCallback(__fail)
+        return d
+
+    def _read_stream(self, response, url, received, timeout):
+        content_type = response.headers.getRawHeaders("Content-Type", [""])
+        content_type = content_type[0].split(";")[0].strip().lower()
+        if response.code >= 400 or content_type not in STREAM_TYPES:
+            # a plain body is a single record
+            d = self._read(response, url)
+            d.addTimeout(timeout, reactor)
+            d.addCallback(lambda body: received(body) or 1)
+            return d
+
+        d = defer.Deferred()
+        response.deliverBody(LineStream(received, d, timeout))
+        return d
+
+    def post(self, url, postdata, timeout=None, connect_timeout=None):
+        """POST postdata to url, fires with the response body"""
+        if isinstance(url, unicode):
+            url = url.encode("UTF-8")
+        timeout = timeout or self.timeout
+        connect_timeout = connect_timeout or self.connect_timeout
+        return self._semaphore(url).run(self._request, url, postdata,
+                                        timeout, connect_timeout)
+
+    def stream(self, url, postdata, received, timeout=None,
+               connect_timeout=None):
+        """POST postdata to url, calling received with each line of a
+        streamed response, or once with a plain body. Fires with the
+        number of calls."""
+        if isinstance(url, unicode):
+            url = url.encode("UTF-8")
+        timeout = timeout or self.timeout
+        connect_timeout = connect_timeout or self.connect_timeout
+        return self._semaphore(url).run(self._request, url, postdata,
+                                        timeout, connect_timeout, received)
+
+    def close(self):
+        return self.pool.closeCachedConnections()
+
+# vim: ts=4 sw=4 ai et
@@ -0,0 +1,86 @@
+# -*- mode: python -*-
+
+"""
+Bounded worker pool for handlers marked `blocking'.
+
+Matching and routing run on the reactor thread. Only blocking handlers
+are handed to this pool, whose results are delivered back to the reactor
+thread. When more than `queue' calls are waiting, new calls are dropped
+(they fire with None) or denied (they fail with PoolFull).
+
+"""
+
+from twisted.internet import reactor, defer, threads
+from twisted.python.threadpool import ThreadPool
+from twisted.python import log
+from logging import WARN
+
+__all__ = ["WorkerPool", "PoolFull"]
+
+POLICIES = ("drop", "deny")
+
+
+class PoolFull(Exception):
+    pass
+
+
+class WorkerPool(object):
+
+    def __init__(self, config=None):
+        config = config or dict()
+        self.size = config.get("size", 4)
+        self.queue = config.get("queue", 64)
+        self.policy = config.get("policy", "drop")
+        if self.policy not in POLICIES:
+            raise ValueError("invalid worker pool policy: %s" % self.policy)
+
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.pending = 0
+        # set by sabo.profiler while the pool is profiled
+        self.profile = None
+
+        self.pool = ThreadPool(1, self.size, name="sabo-workers")
+        self.pool.start()
+        reactor.addSystemEventTrigger("during", "shutdown", self.pool.stop)
+
+    def stats(self):
+        return dict(size=self.size,
+                    queue=self.queue,
+                    pending=self.pending,
+                    waiting=max(0, self.pending - self.size),
+                    submitted=self.submitted,
+                    completed=self.completed,
+                    failed=self.failed,
+                    rejected=self.rejected)
+
+    def _done(self, value, failed):
+        self.pending -= 1
+        if failed:
+            self.failed += 1
+        else:
+            self.completed += 1
+        return value
+
+    def run(self, f, *args, **kwargs):
+        """call f in the pool, results fire on the reactor thread"""
+        if self.pending >= self.size + self.queue:
+            self.rejected += 1
+            log.msg("worker pool full, %s %s" % (self.policy, f.__name__),
+                    level=WARN)
+            if self.policy == "deny":
+                return defer.fail(PoolFull("worker pool is full"))
+            return defer.succeed(None)
+
+        self.submitted += 1
+        self.pending += 1
+        if self.profile is not None:
+            f, args = self.profile, (f,) + args
+        d = threads.deferToThreadPool(reactor, self.pool, f, *args, **kwargs)
+        d.addCallbacks(self._done, self._done,
+                       callbackArgs=(False,), errbackArgs=(True,))
+        return d
+
+# vim: ts=4 sw=4 ai et